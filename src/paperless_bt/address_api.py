@@ -1,6 +1,20 @@
-import aiohttp
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable
+
 from pydantic import BaseModel, ConfigDict, ValidationError
 
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(__name__)
+
+ADDRESS_API_URL = "https://api-adresse.data.gouv.fr"
+
 
 class Geometry(BaseModel):
     model_config = ConfigDict(strict=True)
@@ -40,12 +54,262 @@ class AddressAPIError(Exception):
     pass
 
 
-async def request_address_api(search: str) -> str:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            f"https://api-adresse.data.gouv.fr/search/?q={search}"
-        ) as response:
-            if response.status != 200:
-                error = f"{response.status}: {response.reason}"
-                raise AddressAPIError(f"could not make http request: {error}")
-            return await response.text()
+class AddressAPIUnavailable(AddressAPIError):
+    """The upstream is unhealthy: retries are exhausted or the circuit is open."""
+
+
+class RetryableAddressAPIError(AddressAPIError):
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class RetryPolicy:
+    attempts: int = 3
+    backoff: float = 0.1
+    max_backoff: float = 2.0
+
+    def delay(self, attempt: int, retry_after: float | None = None) -> float:
+        """Seconds to wait before retrying after the given failed attempt.
+
+        Uses "full jitter" exponential backoff so that clients retrying at
+        the same time do not hit the upstream in lockstep. A Retry-After sent
+        by the upstream is honoured up to max_backoff.
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+
+class CircuitBreaker:
+    """Fail fast once the upstream has failed failure_threshold times in a row.
+
+    After reset_timeout seconds a single trial request is let through
+    (half-open): its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def abort_trial(self) -> None:
+        """The trial request ended without an answer, let another one try."""
+        self.trial_in_flight = False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning("address api circuit opened")
+            self.opened_at = self.clock()
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 100):
+        self.latencies: deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float) -> None:
+        self.latencies.append(latency)
+
+    def percentile(self, percentile: float) -> float | None:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+
+class AddressAPIClient:
+    """HTTP client for the address API with timeouts, retries and hedging.
+
+    When hedge_percentile is set, a second identical request is sent if the
+    first one is slower than that percentile of recent latencies, and the
+    first successful answer wins.
+    """
+
+    def __init__(
+        self,
+        base_url: str = ADDRESS_API_URL,
+        connect_timeout: float = 2.0,
+        read_timeout: float = 5.0,
+        retry_policy: RetryPolicy | None = None,
+        circuit_breaker: CircuitBreaker | None = None,
+        hedge_percentile: float | None = None,
+        hedge_min_samples: int = 20,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = LatencyTracker()
+        self.session: "aiohttp.ClientSession | None" = None
+
+    def get_session(self) -> "aiohttp.ClientSession":
+        # created lazily so it is bound to the loop serving requests, aiohttp
+        # is imported here to keep it out of the commands not doing requests
+        import aiohttp
+
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.connect_timeout,
+                    sock_read=self.read_timeout,
+                )
+            )
+        return self.session
+
+    async def warm_up(self) -> None:
+        """Open a pooled connection to the upstream before the first request."""
+        import aiohttp
+
+        try:
+            async with self.get_session().head(f"{self.base_url}/"):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            logger.warning("could not warm up address api connection: {}".format(ex))
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request_once(self, search: str) -> str:
+        import aiohttp
+
+        start = time.monotonic()
+        try:
+            async with self.get_session().get(
+                f"{self.base_url}/search/", params={"q": search}
+            ) as response:
+                if response.status == 429 or response.status >= 500:
+                    raise RetryableAddressAPIError(
+                        f"could not make http request: "
+                        f"{response.status}: {response.reason}",
+                        retry_after=parse_retry_after(response.headers),
+                    )
+                if response.status != 200:
+                    error = f"{response.status}: {response.reason}"
+                    raise AddressAPIError(f"could not make http request: {error}")
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            raise RetryableAddressAPIError(
+                f"could not make http request: {ex!r}"
+            ) from ex
+        self.latencies.record(time.monotonic() - start)
+        return text
+
+    def hedge_delay(self) -> float | None:
+        if (
+            self.hedge_percentile is None
+            or len(self.latencies.latencies) < self.hedge_min_samples
+        ):
+            return None
+        return self.latencies.percentile(self.hedge_percentile)
+
+    async def request_hedged(self, search: str) -> str:
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self.request_once(search)
+        first = asyncio.ensure_future(self.request_once(search))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        pending = {first, asyncio.ensure_future(self.request_once(search))}
+        error: BaseException | None = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    error = task.exception()
+                    if error is None:
+                        return task.result()
+            assert error is not None
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def request(self, search: str) -> str:
+        for attempt in range(self.retry_policy.attempts):
+            trial = self.circuit_breaker.state == "half-open"
+            if not self.circuit_breaker.allow():
+                raise AddressAPIUnavailable("circuit open")
+            try:
+                response = await self.request_hedged(search)
+            except RetryableAddressAPIError as ex:
+                self.circuit_breaker.record_failure()
+                if attempt + 1 == self.retry_policy.attempts:
+                    raise AddressAPIUnavailable(str(ex)) from ex
+                await asyncio.sleep(self.retry_policy.delay(attempt, ex.retry_after))
+                continue
+            except AddressAPIError:
+                # the upstream answered, it is healthy even if it refused us
+                self.circuit_breaker.record_success()
+                raise
+            except BaseException:
+                # cancelled or unexpected: neither a success nor a failure of
+                # the upstream, but the trial must not stay in flight forever
+                if trial:
+                    self.circuit_breaker.abort_trial()
+                raise
+            self.circuit_breaker.record_success()
+            return response
+        raise AddressAPIUnavailable("no attempt allowed by the retry policy")
+
+
+def parse_retry_after(headers) -> float | None:
+    try:
+        return float(headers["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+async def request_address_api(
+    search: str,
+    client: AddressAPIClient | None = None,
+) -> str:
+    if client is not None:
+        return await client.request(search)
+    client = AddressAPIClient()
+    try:
+        return await client.request(search)
+    finally:
+        await client.close()
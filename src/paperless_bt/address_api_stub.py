@@ -0,0 +1,76 @@
+import asyncio
+import random
+from collections import deque
+from dataclasses import dataclass
+
+from aiohttp import web
+
+
+@dataclass
+class Fault:
+    status: int = 200
+    delay: float = 0.0
+
+
+class AddressAPIStub:
+    """Local stand-in for the address API serving a fixture response.
+
+    Every request waits latency seconds and fails with error_status with
+    probability error_rate. Faults queued in faults take precedence and are
+    consumed one per request, which lets tests script exact scenarios.
+    """
+
+    def __init__(
+        self,
+        fixture: str,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+    ):
+        self.fixture = fixture
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.faults: deque[Fault] = deque()
+        self.requests = 0
+        self.searches: list[str] = []
+        self.runner: web.AppRunner | None = None
+        self.url = ""
+
+    def next_fault(self) -> Fault:
+        if self.faults:
+            return self.faults.popleft()
+        if self.error_rate and random.random() < self.error_rate:
+            return Fault(status=self.error_status, delay=self.latency)
+        return Fault(delay=self.latency)
+
+    async def search(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        self.searches.append(request.query.get("q", ""))
+        fault = self.next_fault()
+        if fault.delay:
+            await asyncio.sleep(fault.delay)
+        if fault.status != 200:
+            return web.Response(status=fault.status)
+        return web.Response(text=self.fixture, content_type="application/json")
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/search/", self.search)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start serving and return the base url to give to the client."""
+        self.runner = web.AppRunner(self.application(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        # port 0 let the OS pick a free port, read back the real one
+        bound_host, bound_port = self.runner.addresses[0][:2]
+        self.url = f"http://{bound_host}:{bound_port}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
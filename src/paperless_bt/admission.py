@@ -0,0 +1,88 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, resource: str, retry_after: int):
+        super().__init__(f"{resource} overloaded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Limit the concurrent users of a resource, with a bounded wait queue.
+
+    A request is rejected right away when the queue is full or when the
+    expected wait, estimated from the recent service times, would make it
+    miss its deadline, rather than have it time out after waiting in line.
+    """
+
+    def __init__(self, resource: str, concurrency: int, queue_size: int):
+        self.resource = resource
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+        self.max_waiting = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        # exponentially weighted moving average, in seconds
+        self.service_time = 0.0
+
+    def expected_wait(self) -> float:
+        return (self.waiting + 1) * self.service_time / self.concurrency
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.expected_wait()))
+
+    def reject(self) -> AdmissionRejected:
+        self.rejected += 1
+        return AdmissionRejected(self.resource, self.retry_after())
+
+    async def acquire(self, deadline: float) -> float:
+        """Wait for a slot until deadline, return the time it was acquired."""
+        if self.semaphore.locked():
+            remaining = deadline - time.monotonic()
+            if self.waiting >= self.queue_size or self.expected_wait() > remaining:
+                raise self.reject()
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), remaining)
+            except asyncio.TimeoutError:
+                raise self.reject()
+            finally:
+                self.waiting -= 1
+        else:
+            await self.semaphore.acquire()
+        self.in_flight += 1
+        self.admitted += 1
+        return time.monotonic()
+
+    def release(self, acquired_at: float) -> None:
+        self.in_flight -= 1
+        self.semaphore.release()
+        self.service_time = 0.9 * self.service_time + 0.1 * (
+            time.monotonic() - acquired_at
+        )
+
+    @asynccontextmanager
+    async def slot(self, deadline: float) -> AsyncIterator[None]:
+        acquired_at = await self.acquire(deadline)
+        try:
+            yield
+        finally:
+            self.release(acquired_at)
+
+    def metrics(self) -> dict[str, float]:
+        return {
+            "queue_depth": self.waiting,
+            "max_queue_depth": self.max_waiting,
+            "in_flight": self.in_flight,
+            "admitted_total": self.admitted,
+            "rejected_total": self.rejected,
+            "service_time_seconds": self.service_time,
+        }
@@ -1,19 +1,70 @@
-from fastapi import APIRouter, HTTPException
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from itertools import islice
+from typing import AsyncIterator, Awaitable, Iterable, Iterator, TypeVar
+
+from fastapi import APIRouter, FastAPI, HTTPException, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
-from .address_api import (
-    AddressAPIError,
-    parse_address_api_response,
-    request_address_api,
-)
+from .address_api import AddressAPIError, AddressAPIUnavailable
+from .admission import AdmissionController, AdmissionRejected
+from .geocoder import AddressAPIGeocoder, Geocoder, GeocoderError
 from .mobile_site import (
+    MAX_REACHABLE_DISTANCE,
     MobileSiteGPS,
     ProviderResolver,
+    ReachableMobileSite,
     UnknownProvider,
-    filter_reachable_mobile_sites,
+    group_reachable_mobile_sites,
+    iter_reachable_mobile_sites,
+    limit_reachable_mobile_sites,
     read_mnc,
     read_mobile_site_gps,
 )
+from .mobile_site_diff import (
+    MobileSiteDiffFormatError,
+    MobileSiteGPSDiff,
+    convert_mobile_site_diff,
+    read_mobile_site_diff,
+)
+from .profiling import add_profiling, run_in_thread
+from .site_index import (
+    InvalidRegion,
+    MobileSiteIndex,
+    MobileSiteNotIndexed,
+    Polygon,
+    parse_bbox,
+    parse_polygon,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# a sort key followed by the occurrence of the site among duplicated ones
+CursorKey = tuple[float, str, str, float, float, int]
+
+DEFAULT_PAGE_SIZE = 100
+
+# NDJSON lines produced per trip to the thread pool when streaming
+STREAM_BATCH_SIZE = 100
+
+# geocoding mostly waits on I/O while the site search holds the GIL: the
+# former can have many requests in flight, the latter only a few per worker
+DEFAULT_GEOCODE_CONCURRENCY = 64
+DEFAULT_COMPUTE_CONCURRENCY = 2
+DEFAULT_QUEUE_SIZE = 128
+DEFAULT_QUEUE_TIMEOUT = 1.0
 
 
 class NearestMobileSiteFullOut(BaseModel):
@@ -28,6 +79,32 @@ class NearestMobileSitesFullOut(BaseModel):
     site: dict[str, dict[str, list[NearestMobileSiteFullOut]]]
 
 
+class NearestMobileSitesFullPageOut(NearestMobileSitesFullOut):
+    next_cursor: str | None
+
+
+class NearestMobileSiteStreamOut(BaseModel):
+    provider: str
+    protocol: str
+    coordinates: tuple[float, float]
+    distance: float
+
+
+class DensityCellOut(BaseModel):
+    coordinates: tuple[float, float]
+    count: int
+
+
+class RegionCoverageOut(BaseModel):
+    site: dict[str, dict[str, int]]
+    grid_size: float
+    density: list[DensityCellOut]
+
+
+class InvalidCursor(Exception):
+    pass
+
+
 def reachable_mobiles_sites_to_out(
     reachable_sites: dict[str, dict[str, list[MobileSiteGPS]]],
 ) -> NearestMobileSitesOut:
@@ -58,59 +135,523 @@ def reachable_mobiles_sites_to_full_out(
     return NearestMobileSitesFullOut(site=site)
 
 
+def next_lines(lines: Iterator[str], count: int) -> list[str]:
+    return list(islice(lines, count))
+
+
+def overloaded(ex: AdmissionRejected) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Overloaded.",
+        headers={"Retry-After": str(ex.retry_after)},
+    )
+
+
+def encode_cursor(key: CursorKey) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> CursorKey:
+    try:
+        distance, provider, protocol, x, y, occurrence = json.loads(
+            base64.urlsafe_b64decode(cursor.encode())
+        )
+        return (
+            float(distance),
+            str(provider),
+            str(protocol),
+            float(x),
+            float(y),
+            int(occurrence),
+        )
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+
+def cursor_keys(
+    reachable_sites: Iterable[ReachableMobileSite],
+) -> Iterator[tuple[CursorKey, ReachableMobileSite]]:
+    """Sort sites and give each one a unique cursor key.
+
+    The dataset has duplicated sites with equal sort keys: they are told
+    apart by their occurrence, so a page can end between two of them.
+    """
+    previous = None
+    occurrence = 0
+    for reachable_site in sorted(reachable_sites, key=ReachableMobileSite.sort_key):
+        key = reachable_site.sort_key()
+        occurrence = occurrence + 1 if key == previous else 0
+        previous = key
+        yield (*key, occurrence), reachable_site
+
+
+def paginate_reachable_mobile_sites(
+    reachable_sites: Iterable[ReachableMobileSite],
+    page_size: int,
+    after: CursorKey | None = None,
+) -> tuple[list[ReachableMobileSite], CursorKey | None]:
+    """Return the page of sites following after, ordered by distance.
+
+    The second element is the key of the last returned site when there are
+    more sites to fetch, None otherwise.
+    """
+    following = [
+        (key, reachable_site)
+        for key, reachable_site in cursor_keys(reachable_sites)
+        if after is None or key > after
+    ]
+    page = [reachable_site for _, reachable_site in following[:page_size]]
+    if len(following) > page_size:
+        return page, following[page_size - 1][0]
+    return page, None
+
+
 class ApplicationRouterBuilder:
-    def __init__(self, mnc_csv: str, mobile_sites_gps_csv: str):
-        mobile_sites = read_mobile_site_gps(mobile_sites_gps_csv)
-        brand_mobile_codes = read_mnc(mnc_csv)
+    """Build the application serving the nearest mobile sites.
+
+    Nothing is loaded at construction: load() parses the datasets, builds
+    the index and warms the geocoder up concurrently, and is run in the
+    background by the application lifespan so that /healthz answers while
+    /readyz reports the startup progress.
 
+    Searches are admitted separately to geocoding and to the site search,
+    each with its own concurrency limit and wait queue. A search that can't
+    get both within queue_timeout seconds is shed with a 503 instead of
+    adding to the latency of the admitted ones.
+    """
+
+    def __init__(
+        self,
+        mnc_csv: str,
+        mobile_sites_gps_csv: str,
+        geocoder: Geocoder | None = None,
+        geocode_admission: AdmissionController | None = None,
+        compute_admission: AdmissionController | None = None,
+        queue_timeout: float = DEFAULT_QUEUE_TIMEOUT,
+        admin_token: str | None = None,
+    ):
+        self.mnc_csv = mnc_csv
+        self.mobile_sites_gps_csv = mobile_sites_gps_csv
+        self.geocoder = geocoder or AddressAPIGeocoder()
+        self.geocode_admission = geocode_admission or AdmissionController(
+            "geocode", DEFAULT_GEOCODE_CONCURRENCY, DEFAULT_QUEUE_SIZE
+        )
+        self.compute_admission = compute_admission or AdmissionController(
+            "compute", DEFAULT_COMPUTE_CONCURRENCY, DEFAULT_QUEUE_SIZE
+        )
+        self.queue_timeout = queue_timeout
+        self.admin_token = admin_token
+        self.provider_resolver = ProviderResolver(
+            mobile_sites=[],
+            brand_mobile_codes=[],
+        )
+        self.site_index = MobileSiteIndex()
+        self.site_index_lock = threading.Lock()
+        # sha256 of the diff files applied, so that a diff is applied once
+        self.applied_diffs: set[str] = set()
+        self.applied_diffs_lock = threading.Lock()
+        self.dataset_loaded = False
+        self.ready = False
+        self.startup_error: BaseException | None = None
+        self.startup_timings: dict[str, float] = {}
+
+    async def timed(self, step: str, coroutine: Awaitable[T]) -> T:
+        start = time.perf_counter()
+        res = await coroutine
+        self.startup_timings[step] = time.perf_counter() - start
+        return res
+
+    async def load_mobile_sites(self) -> list[MobileSiteGPS]:
+        mobile_sites = await self.timed(
+            "read_mobile_site_gps",
+            asyncio.to_thread(read_mobile_site_gps, self.mobile_sites_gps_csv),
+        )
+        self.site_index = await self.timed(
+            "build_site_index",
+            asyncio.to_thread(MobileSiteIndex, mobile_sites),
+        )
+        return mobile_sites
+
+    async def load_dataset(self) -> None:
+        if self.dataset_loaded:
+            return
+        mobile_sites, brand_mobile_codes = await asyncio.gather(
+            self.load_mobile_sites(),
+            self.timed("read_mnc", asyncio.to_thread(read_mnc, self.mnc_csv)),
+        )
         self.provider_resolver = ProviderResolver(
             mobile_sites=mobile_sites,
             brand_mobile_codes=brand_mobile_codes,
         )
-        self.mobile_sites = mobile_sites
+        self.dataset_loaded = True
+
+    async def load(self) -> None:
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(
+                self.load_dataset(),
+                self.timed("geocoder_warm_up", self.geocoder.warm_up()),
+            )
+        except Exception as ex:
+            logger.exception("startup failed")
+            self.startup_error = ex
+            return
+        self.startup_timings["total"] = time.perf_counter() - start
+        logger.info(
+            "ready, startup timings: {}".format(
+                " ".join(
+                    f"{step}={duration:.3f}s"
+                    for step, duration in self.startup_timings.items()
+                )
+            )
+        )
+        self.ready = True
+
+    def build_app(self) -> FastAPI:
+        @asynccontextmanager
+        async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+            loading = asyncio.create_task(self.load())
+            yield
+            loading.cancel()
+            await self.geocoder.close()
+
+        app = FastAPI(lifespan=lifespan)
+        app.include_router(self.build())
+        add_profiling(app, self.admin_token)
+        return app
+
+    def apply_mobile_site_diff(self, diff: MobileSiteGPSDiff) -> None:
+        """Update the served sites without reloading the whole dataset.
+
+        The patched index replaces the served one at once: searches running
+        in threads keep iterating the index they started with.
+        """
+        with self.site_index_lock:
+            self.site_index = self.site_index.patched(diff)
+
+    def apply_mobile_site_diff_file(self, filename: str) -> bool:
+        """Apply a diff written by the diff command, return whether it applied.
+
+        A diff already applied is skipped: SIGHUP also replaces the workers
+        of serve, and applying additions again would duplicate the sites.
+        """
+        if not self.dataset_loaded:
+            logger.error("could not apply {}: dataset not loaded".format(filename))
+            return False
+        with self.applied_diffs_lock:
+            try:
+                with open(filename, "rb") as diff_file:
+                    digest = hashlib.sha256(diff_file.read()).hexdigest()
+                if digest in self.applied_diffs:
+                    logger.info("{} already applied, skipped".format(filename))
+                    return False
+                diff = convert_mobile_site_diff(read_mobile_site_diff(filename))
+                self.apply_mobile_site_diff(diff)
+            except (OSError, MobileSiteDiffFormatError, MobileSiteNotIndexed) as ex:
+                logger.error("could not apply {}: {!r}".format(filename, ex))
+                return False
+            self.applied_diffs.add(digest)
+        logger.info(
+            "applied {}: {} sites removed, {} added".format(
+                filename, len(diff.removed), len(diff.added)
+            )
+        )
+        return True
+
+    def resolve_provider(self, provider: str) -> str:
+        try:
+            return self.provider_resolver.resolve(provider)
+        except UnknownProvider:
+            return provider
+
+    def resolve_providers(
+        self,
+        reachable_sites: dict[str, dict[str, list[MobileSiteGPS]]],
+    ) -> dict[str, dict[str, list[MobileSiteGPS]]]:
+        return {
+            self.resolve_provider(provider): sites_by_protocol
+            for provider, sites_by_protocol in reachable_sites.items()
+        }
+
+    def region_coverage(
+        self,
+        polygon: Polygon,
+        grid_size: float,
+    ) -> RegionCoverageOut:
+        coverage = self.site_index.coverage(polygon, grid_size)
+        site: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        # several provider ids may belong to the same brand
+        for provider, count_by_protocol in coverage.site.items():
+            for protocol, count in count_by_protocol.items():
+                site[self.resolve_provider(provider)][protocol] += count
+        return RegionCoverageOut(
+            site=site,
+            grid_size=grid_size,
+            density=[
+                DensityCellOut(coordinates=coordinates, count=count)
+                for coordinates, count in sorted(coverage.density.items())
+            ],
+        )
+
+    def nearest_mobile_sites(
+        self,
+        position: tuple[float, float],
+        full: bool,
+        limit: int | None,
+        page_size: int | None,
+        after: CursorKey | None,
+    ) -> NearestMobileSitesOut | NearestMobileSitesFullOut:
+        reachable_sites: Iterable[ReachableMobileSite] = iter_reachable_mobile_sites(
+            position,
+            self.site_index.near(position, MAX_REACHABLE_DISTANCE),
+        )
+        if not full:
+            return reachable_mobiles_sites_to_out(
+                self.resolve_providers(group_reachable_mobile_sites(reachable_sites))
+            )
+
+        if limit is not None:
+            reachable_sites = limit_reachable_mobile_sites(
+                sorted(reachable_sites, key=ReachableMobileSite.sort_key),
+                limit,
+            )
+        if page_size is None and after is None:
+            return reachable_mobiles_sites_to_full_out(
+                self.resolve_providers(group_reachable_mobile_sites(reachable_sites))
+            )
+
+        page, next_key = paginate_reachable_mobile_sites(
+            reachable_sites,
+            page_size or DEFAULT_PAGE_SIZE,
+            after,
+        )
+        return NearestMobileSitesFullPageOut(
+            site=reachable_mobiles_sites_to_full_out(
+                self.resolve_providers(group_reachable_mobile_sites(page))
+            ).site,
+            next_cursor=None if next_key is None else encode_cursor(next_key),
+        )
+
+    async def stream_admitted(
+        self,
+        lines: Iterator[str],
+        acquired_at: float,
+    ) -> AsyncIterator[str]:
+        """Produce lines by batches in a thread, like the other searches.
+
+        The compute slot is released once the whole response is streamed.
+        """
+        try:
+            while batch := await run_in_thread(next_lines, lines, STREAM_BATCH_SIZE):
+                yield "".join(batch)
+        finally:
+            self.compute_admission.release(acquired_at)
+
+    def metrics(self) -> str:
+        """Admission metrics in the Prometheus text format."""
+        metrics = {
+            admission.resource: admission.metrics()
+            for admission in (self.geocode_admission, self.compute_admission)
+        }
+        lines = []
+        for name in metrics["geocode"]:
+            metric = f"paperless_bt_admission_{name}"
+            kind = "counter" if name.endswith("_total") else "gauge"
+            lines.append(f"# TYPE {metric} {kind}")
+            for resource, values in metrics.items():
+                lines.append(f'{metric}{{resource="{resource}"}} {values[name]}')
+        return "\n".join(lines) + "\n"
+
+    def stream_reachable_mobile_sites(
+        self,
+        reachable_sites: Iterable[ReachableMobileSite],
+    ) -> Iterator[str]:
+        """Serialize sites as NDJSON lines as soon as they are found."""
+        for reachable_site in reachable_sites:
+            mobile_site = reachable_site.mobile_site
+            yield (
+                NearestMobileSiteStreamOut(
+                    provider=self.resolve_provider(mobile_site.provider),
+                    protocol=reachable_site.protocol,
+                    coordinates=(mobile_site.gps[0], mobile_site.gps[1]),
+                    distance=reachable_site.distance,
+                ).model_dump_json()
+                + "\n"
+            )
 
     def build(self) -> APIRouter:
         router = APIRouter()
 
-        @router.get("/")
+        @router.get("/healthz")
+        async def healthz() -> dict[str, str]:
+            """Liveness: the process serves requests and its startup did not fail."""
+            if self.startup_error is not None:
+                raise HTTPException(status_code=500, detail="Startup failed.")
+            return {"status": "ok"}
+
+        @router.get("/readyz")
+        async def readyz() -> dict[str, str]:
+            """Readiness: the dataset is loaded and searches can be served."""
+            if not self.ready:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Startup failed." if self.startup_error else "Starting.",
+                )
+            return {"status": "ready"}
+
+        @router.get("/metrics", response_class=PlainTextResponse)
+        async def metrics() -> str:
+            """Queue depth, in flight and shed searches of each admission."""
+            return self.metrics()
+
+        @router.get("/region")
+        async def region(
+            bbox: str | None = None,
+            polygon: str | None = None,
+            grid_size: float = 0.1,
+        ) -> RegionCoverageOut:
+            """Count the sites in a region by provider/protocol and grid cell.
+
+            The region is either a bbox "min_x,min_y,max_x,max_y" or a polygon
+            "x1,y1,x2,y2,...", in the same GPS coordinates as the sites.
+            """
+            if not self.ready:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Service starting.",
+                    headers={"Retry-After": "1"},
+                )
+            if (bbox is None) == (polygon is None):
+                raise HTTPException(
+                    status_code=400,
+                    detail="Exactly one of bbox and polygon is required.",
+                )
+            if not math.isfinite(grid_size) or grid_size <= 0:
+                raise HTTPException(
+                    status_code=400,
+                    detail="grid_size must be a positive number.",
+                )
+            try:
+                region = parse_bbox(bbox) if bbox else parse_polygon(polygon or "")
+            except InvalidRegion:
+                raise HTTPException(status_code=400, detail="Invalid region.")
+            try:
+                async with self.compute_admission.slot(
+                    time.monotonic() + self.queue_timeout
+                ):
+                    return await run_in_thread(self.region_coverage, region, grid_size)
+            except AdmissionRejected as ex:
+                raise overloaded(ex)
+
+        @router.get(
+            "/",
+            response_model=NearestMobileSitesOut
+            | NearestMobileSitesFullOut
+            | NearestMobileSitesFullPageOut,
+        )
         async def root(
             search: str,
             full: bool = False,
-        ) -> NearestMobileSitesOut | NearestMobileSitesFullOut:
+            limit: int | None = None,
+            page_size: int | None = None,
+            cursor: str | None = None,
+            stream: bool = False,
+        ) -> (
+            NearestMobileSitesOut
+            | NearestMobileSitesFullOut
+            | NearestMobileSitesFullPageOut
+            | Response
+        ):
+            """Count mobile sites reachable from the searched address.
+
+            With full, the sites themselves are returned. limit keeps at most
+            that many sites per provider/protocol, nearest first. page_size
+            and cursor page through sites ordered by distance, and stream
+            emits NDJSON lines in scan order instead of one JSON body, so it
+            can't be limited to the nearest sites.
+            """
+            if (limit is not None and limit < 1) or (
+                page_size is not None and page_size < 1
+            ):
+                raise HTTPException(
+                    status_code=400,
+                    detail="limit and page_size must be positive.",
+                )
+            if stream and (
+                limit is not None or page_size is not None or cursor is not None
+            ):
+                raise HTTPException(
+                    status_code=400,
+                    detail="stream can't be used with limit, page_size or cursor.",
+                )
+            if not self.ready:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Service starting.",
+                    headers={"Retry-After": "1"},
+                )
             try:
-                first_feature = parse_address_api_response(
-                    await request_address_api(search)
-                ).features[0]
+                after = None if cursor is None else decode_cursor(cursor)
+            except InvalidCursor:
+                raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+            # each admission bounds the wait in its own queue: the time spent
+            # geocoding doesn't count against the wait for a compute slot
+            try:
+                async with self.geocode_admission.slot(
+                    time.monotonic() + self.queue_timeout
+                ):
+                    first_feature = (await self.geocoder.geocode(search)).features[0]
+            except AdmissionRejected as ex:
+                raise overloaded(ex)
+            except AddressAPIUnavailable:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Address API unavailable.",
+                )
             # something bad happened to know gps cooardinates so give up early
-            except (AddressAPIError, IndexError):
+            except (AddressAPIError, GeocoderError, IndexError):
                 raise HTTPException(
                     status_code=500,
                     detail="Can't found GPS coordinates.",
                 )
             search_site_coordinates = first_feature.geometry.coordinates
 
-            reachable_mobiles_sites = filter_reachable_mobile_sites(
-                (search_site_coordinates[0], search_site_coordinates[1]),
-                self.mobile_sites,
-            )
+            position = (search_site_coordinates[0], search_site_coordinates[1])
+            try:
+                acquired_at = await self.compute_admission.acquire(
+                    time.monotonic() + self.queue_timeout
+                )
+            except AdmissionRejected as ex:
+                raise overloaded(ex)
 
-            reachable_mobiles_sites_with_resolved_provider = {}
-            for provider, sites_by_protocol in reachable_mobiles_sites.items():
-                try:
-                    provider = self.provider_resolver.resolve(provider)
-                except UnknownProvider:
-                    provider = provider
-                reachable_mobiles_sites_with_resolved_provider[
-                    provider
-                ] = sites_by_protocol
-
-            if full:
-                return reachable_mobiles_sites_to_full_out(
-                    reachable_mobiles_sites_with_resolved_provider
+            if stream:
+                reachable_sites: Iterable[ReachableMobileSite] = (
+                    iter_reachable_mobile_sites(
+                        position,
+                        self.site_index.near(position, MAX_REACHABLE_DISTANCE),
+                    )
                 )
-            else:
-                return reachable_mobiles_sites_to_out(
-                    reachable_mobiles_sites_with_resolved_provider
+                return StreamingResponse(
+                    self.stream_admitted(
+                        self.stream_reachable_mobile_sites(reachable_sites),
+                        acquired_at,
+                    ),
+                    media_type="application/x-ndjson",
+                )
+
+            # searched in a thread so that the event loop keeps admitting and
+            # shedding requests meanwhile
+            try:
+                return await run_in_thread(
+                    self.nearest_mobile_sites,
+                    position,
+                    full,
+                    limit,
+                    page_size,
+                    after,
                 )
+            finally:
+                self.compute_admission.release(acquired_at)
 
         return router
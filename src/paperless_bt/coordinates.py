@@ -1,7 +1,9 @@
 import math
-from typing import Callable, Iterator, TypeVar
+from functools import cache
+from typing import TYPE_CHECKING, Callable, Iterator, TypeVar
 
-from pyproj import Transformer
+if TYPE_CHECKING:
+    from pyproj import Transformer
 
 EARTH_RADIUS = 6371e3
 
@@ -32,14 +34,22 @@ def compute_haversine(
     )
 
 
-def lamber93_to_gps(x: int, y: int) -> tuple[int, int]:
-    lambert = Transformer.from_crs(
+@cache
+def lambert93_transformer() -> "Transformer":
+    # pyproj is slow to import and the transformer slow to build, only pay
+    # for them once and when a conversion is actually needed
+    from pyproj import Transformer
+
+    return Transformer.from_crs(
         """+proj=lcc +lat_1=49 +lat_2=44 +lat_0=46.5 +lon_0=3
 +x_0=700000 +y_0=6600000 +ellps=GRS80 +towgs84=0,0,0,0,0,0,0
 +units=m +no_defs""",
         "+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs",
     )
-    return lambert.transform(x, y)
+
+
+def lamber93_to_gps(x: int, y: int) -> tuple[int, int]:
+    return lambert93_transformer().transform(x, y)
 
 
 T = TypeVar("T")
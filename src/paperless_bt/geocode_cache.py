@@ -0,0 +1,149 @@
+import os
+import re
+import sqlite3
+import time
+from typing import Callable
+
+from .address_api import FeatureCollection
+from .geocoder import Geocoder
+
+
+def normalize_search(search: str) -> str:
+    # "8+bd+du+port" and "8 Bd du  Port" are the same search for the API
+    return " ".join(re.split(r"[\s+]+", search.strip().lower()))
+
+
+class GeocodeCache:
+    """Geocode results persisted in SQLite, shared by processes and restarts.
+
+    The database is in WAL mode so that several uvicorn workers can read
+    while one of them writes. Entries older than ttl seconds are ignored and
+    every compact_every writes the least recently used entries are dropped
+    to keep at most max_entries.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 7 * 24 * 3600,
+        max_entries: int = 100_000,
+        compact_every: int = 1000,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.compact_every = compact_every
+        self.clock = clock
+        self.writes = 0
+        self.connection: sqlite3.Connection | None = None
+        self.connection_pid: int | None = None
+
+    def get_connection(self) -> sqlite3.Connection:
+        # sqlite connections must not be shared with forked processes
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(
+                self.path,
+                timeout=5.0,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS geocodes ("
+                "search TEXT PRIMARY KEY,"
+                " response TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS geocodes_accessed_at"
+                " ON geocodes(accessed_at)"
+            )
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    def get(self, search: str) -> FeatureCollection | None:
+        now = self.clock()
+        connection = self.get_connection()
+        row = connection.execute(
+            "SELECT response, accessed_at FROM geocodes"
+            " WHERE search = ? AND created_at >= ?",
+            (normalize_search(search), now - self.ttl),
+        ).fetchone()
+        if row is None:
+            return None
+        response, accessed_at = row
+        # only refresh the LRU timestamp once a minute to avoid a write per hit
+        if now - accessed_at > 60:
+            connection.execute(
+                "UPDATE geocodes SET accessed_at = ? WHERE search = ?",
+                (now, normalize_search(search)),
+            )
+        return FeatureCollection.model_validate_json(response)
+
+    def put(self, search: str, collection: FeatureCollection) -> None:
+        now = self.clock()
+        self.get_connection().execute(
+            "INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)",
+            (normalize_search(search), collection.model_dump_json(), now, now),
+        )
+        self.writes += 1
+        if self.writes % self.compact_every == 0:
+            self.compact()
+
+    def __contains__(self, search: str) -> bool:
+        return self.get(search) is not None
+
+    def __len__(self) -> int:
+        return (
+            self.get_connection().execute("SELECT COUNT(*) FROM geocodes").fetchone()[0]
+        )
+
+    def compact(self) -> int:
+        """Drop expired entries then the least recently used ones.
+
+        Returns the number of dropped entries.
+        """
+        connection = self.get_connection()
+        dropped = connection.execute(
+            "DELETE FROM geocodes WHERE created_at < ?",
+            (self.clock() - self.ttl,),
+        ).rowcount
+        dropped += connection.execute(
+            "DELETE FROM geocodes WHERE search IN ("
+            " SELECT search FROM geocodes ORDER BY accessed_at DESC"
+            " LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        return dropped
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class CachingGeocoder(Geocoder):
+    def __init__(self, geocoder: Geocoder, cache: GeocodeCache):
+        self.geocoder = geocoder
+        self.cache = cache
+
+    async def geocode(self, search: str) -> FeatureCollection:
+        collection = self.cache.get(search)
+        if collection is not None:
+            return collection
+        collection = await self.geocoder.geocode(search)
+        # an empty answer may be a transient upstream issue, do not keep it
+        if collection.features:
+            self.cache.put(search, collection)
+        return collection
+
+    async def warm_up(self) -> None:
+        self.cache.get_connection()
+        await self.geocoder.warm_up()
+
+    async def close(self) -> None:
+        self.cache.close()
+        await self.geocoder.close()
@@ -0,0 +1,186 @@
+import csv
+import gzip
+import logging
+import os
+import re
+import sqlite3
+from abc import ABC, abstractmethod
+from typing import IO
+
+from .address_api import (
+    AddressAPIClient,
+    Feature,
+    FeatureCollection,
+    Geometry,
+    Properties,
+    parse_address_api_response,
+)
+
+logger = logging.getLogger(__name__)
+
+# common abbreviations used in searches and their BAN spelling
+ABBREVIATIONS = {
+    "av": "avenue",
+    "bd": "boulevard",
+    "bld": "boulevard",
+    "ch": "chemin",
+    "imp": "impasse",
+    "pl": "place",
+    "r": "rue",
+    "rte": "route",
+    "st": "saint",
+    "ste": "sainte",
+}
+
+
+class GeocoderError(Exception):
+    pass
+
+
+class BANFormatError(Exception):
+    pass
+
+
+class Geocoder(ABC):
+    @abstractmethod
+    async def geocode(self, search: str) -> FeatureCollection:
+        """Return candidate addresses for search, best match first."""
+
+    async def warm_up(self) -> None:
+        """Prepare connections so that the first geocode is not slower."""
+
+    async def close(self) -> None:
+        pass
+
+
+class AddressAPIGeocoder(Geocoder):
+    def __init__(self, client: AddressAPIClient | None = None):
+        self.client = client or AddressAPIClient()
+
+    async def geocode(self, search: str) -> FeatureCollection:
+        return parse_address_api_response(await self.client.request(search))
+
+    async def warm_up(self) -> None:
+        await self.client.warm_up()
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+def search_to_fts_query(search: str) -> str:
+    tokens = [
+        ABBREVIATIONS.get(token, token)
+        for token in re.split(r"[\W_]+", search.lower())
+        if token
+    ]
+    if not tokens:
+        raise GeocoderError(f"nothing to search in {search!r}")
+    # the last token may be incomplete while the user is typing
+    return " ".join(f'"{token}"' for token in tokens[:-1]) + f' "{tokens[-1]}"*'
+
+
+class LocalGeocoder(Geocoder):
+    """Geocode from an SQLite FTS5 index built by build_local_geocoder_index."""
+
+    def __init__(self, index: str, limit: int = 5):
+        if not os.path.exists(index):
+            raise GeocoderError(f"no geocoder index at {index}")
+        self.index = index
+        self.limit = limit
+        self.connection: sqlite3.Connection | None = None
+        self.connection_pid: int | None = None
+
+    def get_connection(self) -> sqlite3.Connection:
+        # sqlite connections must not be shared with forked processes
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(
+                f"file:{self.index}?mode=ro",
+                uri=True,
+                check_same_thread=False,
+            )
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    async def geocode(self, search: str) -> FeatureCollection:
+        rows = self.get_connection().execute(
+            "SELECT label, lon, lat, x, y FROM addresses"
+            " WHERE addresses MATCH ? ORDER BY rank LIMIT ?",
+            (search_to_fts_query(search), self.limit),
+        )
+        return FeatureCollection(
+            features=[
+                Feature(
+                    geometry=Geometry(coordinates=[lon, lat]),
+                    properties=Properties(label=label, x=x, y=y),
+                )
+                for label, lon, lat, x, y in rows
+            ]
+        )
+
+    async def warm_up(self) -> None:
+        self.get_connection().execute("SELECT label FROM addresses LIMIT 1").fetchone()
+
+    async def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def open_ban_csv(filename: str) -> IO[str]:
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rt", newline="", encoding="utf-8")
+    return open(filename, newline="", encoding="utf-8")
+
+
+def ban_row_to_address(row: dict[str, str]) -> tuple[str, float, float, float, float]:
+    street = " ".join(
+        part for part in (row["numero"], row["rep"], row["nom_voie"]) if part
+    )
+    return (
+        f"{street} {row['code_postal']} {row['nom_commune']}",
+        float(row["lon"]),
+        float(row["lat"]),
+        float(row["x"]),
+        float(row["y"]),
+    )
+
+
+def build_local_geocoder_index(ban_csv: str, index: str) -> int:
+    """Build the LocalGeocoder index from a BAN addresses export.
+
+    Returns the number of indexed addresses. The index is built aside and
+    only replaces an existing one once complete.
+    """
+    tmp_index = f"{index}.tmp"
+    if os.path.exists(tmp_index):
+        os.remove(tmp_index)
+    connection = sqlite3.connect(tmp_index)
+    count = 0
+    try:
+        connection.execute(
+            "CREATE VIRTUAL TABLE addresses USING fts5("
+            "label, lon UNINDEXED, lat UNINDEXED, x UNINDEXED, y UNINDEXED,"
+            " tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        with open_ban_csv(ban_csv) as csvfile:
+            for row in csv.DictReader(csvfile, delimiter=";"):
+                try:
+                    address = ban_row_to_address(row)
+                except (KeyError, TypeError, ValueError):
+                    logger.error("incorrect row: {}".format(row))
+                    raise BANFormatError
+                connection.execute(
+                    "INSERT INTO addresses VALUES (?, ?, ?, ?, ?)", address
+                )
+                count += 1
+        if count == 0:
+            raise BANFormatError
+        connection.execute("INSERT INTO addresses(addresses) VALUES ('optimize')")
+        connection.commit()
+    except BaseException:
+        connection.close()
+        os.remove(tmp_index)
+        raise
+    connection.close()
+    os.replace(tmp_index, index)
+    return count
@@ -0,0 +1,171 @@
+import asyncio
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from itertools import cycle
+from typing import Iterable, Iterator
+
+import aiohttp
+
+from .request_log import LoggedRequest, request_query_string
+
+
+@dataclass
+class LoadTestResult:
+    duration: float = 0.0
+    latencies: list[float] = field(default_factory=list)
+    statuses: Counter[int] = field(default_factory=Counter)
+    # requests without a response, by exception name
+    failures: Counter[str] = field(default_factory=Counter)
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies)
+
+    def throughput(self) -> float:
+        return self.requests / self.duration if self.duration else 0.0
+
+    def errors(self) -> int:
+        return sum(
+            count for status, count in self.statuses.items() if status >= 400
+        ) + sum(self.failures.values())
+
+    def error_rate(self) -> float:
+        return self.errors() / self.requests if self.requests else 0.0
+
+    def percentile(self, percentile: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def summary(self) -> dict:
+        return {
+            "requests": self.requests,
+            "duration": self.duration,
+            "throughput": self.throughput(),
+            "latency": {
+                f"p{percentile}": self.percentile(percentile)
+                for percentile in (50, 90, 99, 100)
+            },
+            "statuses": {str(status): count for status, count in self.statuses.items()},
+            "failures": dict(self.failures),
+            "error_rate": self.error_rate(),
+        }
+
+    def report(self) -> str:
+        lines = [
+            f"requests: {self.requests} in {self.duration:.2f}s "
+            f"({self.throughput():.1f} req/s)",
+            "latency: "
+            + " ".join(
+                f"p{percentile}={self.percentile(percentile) * 1000:.1f}ms"
+                for percentile in (50, 90, 99, 100)
+            ),
+            "status: "
+            + " ".join(
+                f"{status}={count}" for status, count in sorted(self.statuses.items())
+            ),
+            f"errors: {self.errors()} ({self.error_rate():.2%})",
+        ]
+        if self.failures:
+            lines.append(
+                "failures: "
+                + " ".join(f"{name}={count}" for name, count in self.failures.items())
+            )
+        return "\n".join(lines)
+
+
+class LoadTest:
+    """Replay logged searches against a server and measure its answers.
+
+    With rps, searches are sent on a fixed schedule whatever the server
+    latency (open loop), and latencies are measured from the scheduled send
+    time so that a stalled server can't hide queueing delays. Otherwise
+    concurrency searches are kept in flight (closed loop). The log is
+    replayed once, or in a loop for duration seconds.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        requests: list[LoggedRequest],
+        rps: float | None = None,
+        concurrency: int = 8,
+        duration: float | None = None,
+        timeout: float = 10.0,
+    ):
+        self.url = url.rstrip("/")
+        self.requests = requests
+        self.rps = rps
+        self.concurrency = concurrency
+        self.duration = duration
+        self.timeout = timeout
+        self.result = LoadTestResult()
+
+    def iter_requests(self) -> Iterator[LoggedRequest]:
+        if self.duration is None:
+            return iter(self.requests)
+        return cycle(self.requests)
+
+    async def send(
+        self,
+        session: aiohttp.ClientSession,
+        request: LoggedRequest,
+        scheduled: float,
+    ) -> None:
+        try:
+            async with session.get(
+                f"{self.url}/?{request_query_string(request)}"
+            ) as response:
+                await response.read()
+                self.result.statuses[response.status] += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            self.result.failures[type(ex).__name__] += 1
+        self.result.latencies.append(time.monotonic() - scheduled)
+
+    async def open_loop(
+        self,
+        session: aiohttp.ClientSession,
+        requests: Iterable[LoggedRequest],
+        start: float,
+        end: float | None,
+    ) -> None:
+        assert self.rps is not None
+        sending = []
+        for i, request in enumerate(requests):
+            scheduled = start + i / self.rps
+            if end is not None and scheduled >= end:
+                break
+            await asyncio.sleep(scheduled - time.monotonic())
+            sending.append(asyncio.create_task(self.send(session, request, scheduled)))
+        await asyncio.gather(*sending)
+
+    async def closed_loop(
+        self,
+        session: aiohttp.ClientSession,
+        requests: Iterator[LoggedRequest],
+        end: float | None,
+    ) -> None:
+        async def worker() -> None:
+            for request in requests:
+                if end is not None and time.monotonic() >= end:
+                    return
+                await self.send(session, request, time.monotonic())
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    async def run(self) -> LoadTestResult:
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            # the load is bounded by rps or concurrency, not by the pool
+            connector=aiohttp.TCPConnector(limit=0),
+        ) as session:
+            start = time.monotonic()
+            end = None if self.duration is None else start + self.duration
+            if self.rps is not None:
+                await self.open_loop(session, self.iter_requests(), start, end)
+            else:
+                await self.closed_loop(session, self.iter_requests(), end)
+            self.result.duration = time.monotonic() - start
+        return self.result
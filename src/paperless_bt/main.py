@@ -1,78 +1,589 @@
-import asyncio
-import csv
+import logging
+import math
+import os
 from functools import wraps
 
 import click
-import uvicorn
-from fastapi import FastAPI
 
-from .application_router import ApplicationRouterBuilder
-from .mobile_site import (
-    convert_lanbert93_to_gps,
-    read_mobile_site,
-)
+# commands import what they need themselves: importing fastapi, uvicorn,
+# aiohttp or pyproj here would slow every command down, --help included.
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
 
 @click.group()
 def cli():
-    import logging
-
-    logging.basicConfig(format="[%(asctime)s] %(filename)s->%(funcName)s: %(message)s")
+    logging.basicConfig(
+        format="[%(asctime)s] %(filename)s->%(funcName)s: %(message)s",
+        level=logging.INFO,
+    )
 
 
 def async_cmd(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
+        import asyncio
+
         loop = asyncio.get_event_loop()
         return loop.run_until_complete(f(*args, **kwargs))
 
     return wrapper
 
 
+def geocoder_options(f):
+    """Options shared by the commands that need to geocode searches."""
+    options = [
+        click.option(
+            "--address-api-url",
+            help="Base url of the address API, the public one by default.",
+        ),
+        click.option("--connect-timeout", default=2.0, show_default=True),
+        click.option("--read-timeout", default=5.0, show_default=True),
+        click.option(
+            "--hedge-percentile",
+            type=float,
+            help="Send a second address API request when the first one is "
+            "slower than this percentile of recent latencies.",
+        ),
+        click.option(
+            "--geocoder-index",
+            type=click.Path(exists=True),
+            help="Geocode locally from an index built with "
+            "build-geocoder-index instead of calling the address API.",
+        ),
+        click.option(
+            "--geocode-cache",
+            type=click.Path(),
+            help="SQLite file caching geocode results across workers and restarts.",
+        ),
+        click.option(
+            "--geocode-cache-ttl",
+            default=7 * 24 * 3600.0,
+            show_default=True,
+            help="Seconds a cached geocode result stays valid.",
+        ),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+def admission_options(f):
+    """Options of the load shedding done by the servers, per worker."""
+    options = [
+        click.option(
+            "--geocode-concurrency",
+            default=64,
+            show_default=True,
+            help="Searches geocoded at the same time.",
+        ),
+        click.option(
+            "--compute-concurrency",
+            default=2,
+            show_default=True,
+            help="Searches looking for their sites at the same time.",
+        ),
+        click.option(
+            "--queue-size",
+            default=128,
+            show_default=True,
+            help="Searches waiting for geocoding or for the site search "
+            "before new ones are rejected.",
+        ),
+        click.option(
+            "--queue-timeout",
+            default=1.0,
+            show_default=True,
+            help="Seconds a search may wait in each queue before being rejected.",
+        ),
+        click.option(
+            "--admin-token",
+            envvar="PAPERLESS_BT_ADMIN_TOKEN",
+            help="Token to send in X-Admin-Token to profile a request with "
+            "X-Profile, profiling is disabled without it.",
+        ),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+def make_admission_kwargs(
+    geocode_concurrency,
+    compute_concurrency,
+    queue_size,
+    queue_timeout,
+    admin_token,
+):
+    from .admission import AdmissionController
+
+    return {
+        "geocode_admission": AdmissionController(
+            "geocode", geocode_concurrency, queue_size
+        ),
+        "compute_admission": AdmissionController(
+            "compute", compute_concurrency, queue_size
+        ),
+        "queue_timeout": queue_timeout,
+        "admin_token": admin_token,
+    }
+
+
+def make_geocoder(
+    address_api_url,
+    connect_timeout,
+    read_timeout,
+    hedge_percentile,
+    geocoder_index,
+    geocode_cache,
+    geocode_cache_ttl,
+):
+    from .address_api import ADDRESS_API_URL, AddressAPIClient
+    from .geocode_cache import CachingGeocoder, GeocodeCache
+    from .geocoder import AddressAPIGeocoder, LocalGeocoder
+
+    if geocoder_index is not None:
+        geocoder = LocalGeocoder(geocoder_index)
+    else:
+        geocoder = AddressAPIGeocoder(
+            AddressAPIClient(
+                base_url=address_api_url or ADDRESS_API_URL,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+                hedge_percentile=hedge_percentile,
+            )
+        )
+    if geocode_cache is not None:
+        geocoder = CachingGeocoder(
+            geocoder,
+            GeocodeCache(geocode_cache, ttl=geocode_cache_ttl),
+        )
+    return geocoder
+
+
 @cli.command()
 @click.argument("mnc_csv", type=click.Path(exists=True))
 @click.argument("mobile_site_gps_csv", type=click.Path(exists=True))
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=5000, show_default=True)
+@click.option(
+    "--reload-diff",
+    type=click.Path(),
+    help="Diff written by the diff command, applied to the served sites "
+    "on SIGHUP without reloading them.",
+)
+@geocoder_options
+@admission_options
 @async_cmd
-async def run(mnc_csv, mobile_site_gps_csv):
+async def run(
+    mnc_csv,
+    mobile_site_gps_csv,
+    host,
+    port,
+    reload_diff,
+    geocode_concurrency,
+    compute_concurrency,
+    queue_size,
+    queue_timeout,
+    admin_token,
+    **geocoder_kwargs,
+):
     """Run the server."""
-    app.include_router(
-        ApplicationRouterBuilder(
-            mnc_csv,
-            mobile_site_gps_csv,
-        ).build()
+    import asyncio
+    import signal
+
+    import uvicorn
+
+    from .application_router import ApplicationRouterBuilder
+
+    builder = ApplicationRouterBuilder(
+        mnc_csv,
+        mobile_site_gps_csv,
+        geocoder=make_geocoder(**geocoder_kwargs),
+        **make_admission_kwargs(
+            geocode_concurrency,
+            compute_concurrency,
+            queue_size,
+            queue_timeout,
+            admin_token,
+        ),
     )
+    if reload_diff is not None:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(
+            signal.SIGHUP,
+            lambda: loop.run_in_executor(
+                None, builder.apply_mobile_site_diff_file, reload_diff
+            ),
+        )
     config = uvicorn.Config(
-        app,
-        port=5000,
+        builder.build_app(),
+        host=host,
+        port=port,
         log_level="info",
     )
     server = uvicorn.Server(config)
     await server.serve()
 
 
+@cli.command()
+@click.argument("mnc_csv", type=click.Path(exists=True))
+@click.argument("mobile_site_gps_csv", type=click.Path(exists=True))
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=5000, show_default=True)
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True)
+@click.option(
+    "--max-requests",
+    type=int,
+    help="Recycle a worker after this many requests.",
+)
+@click.option("--max-requests-jitter", default=0, show_default=True)
+@click.option(
+    "--memory-report-interval",
+    default=60.0,
+    show_default=True,
+    help="Seconds between two logs of the workers memory.",
+)
+@click.option(
+    "--reload-diff",
+    type=click.Path(),
+    help="Diff written by the diff command, applied to the served sites "
+    "on SIGHUP without reloading them.",
+)
+@geocoder_options
+@admission_options
+def serve(
+    mnc_csv,
+    mobile_site_gps_csv,
+    host,
+    port,
+    workers,
+    max_requests,
+    max_requests_jitter,
+    memory_report_interval,
+    reload_diff,
+    geocode_concurrency,
+    compute_concurrency,
+    queue_size,
+    queue_timeout,
+    admin_token,
+    **geocoder_kwargs,
+):
+    """Run the server with several worker processes.
+
+    The dataset is loaded once before forking the workers, which share it.
+    """
+    import asyncio
+
+    from .application_router import ApplicationRouterBuilder
+    from .serving import PreforkServer
+
+    builder = ApplicationRouterBuilder(
+        mnc_csv,
+        mobile_site_gps_csv,
+        geocoder=make_geocoder(**geocoder_kwargs),
+        **make_admission_kwargs(
+            geocode_concurrency,
+            compute_concurrency,
+            queue_size,
+            queue_timeout,
+            admin_token,
+        ),
+    )
+    # workers only have to warm their geocoder up in their lifespan
+    asyncio.run(builder.load_dataset())
+    PreforkServer(
+        builder.build_app(),
+        host=host,
+        port=port,
+        workers=workers,
+        max_requests=max_requests,
+        max_requests_jitter=max_requests_jitter,
+        memory_report_interval=memory_report_interval,
+        on_reload=None
+        if reload_diff is None
+        else lambda: builder.apply_mobile_site_diff_file(reload_diff),
+    ).run()
+
+
+@cli.command()
+@click.argument("mnc_csv", type=click.Path(exists=True))
+@click.argument("mobile_site_gps_csv", type=click.Path(exists=True))
+@click.option("--bbox", help="min_x,min_y,max_x,max_y")
+@click.option("--polygon", help="x1,y1,x2,y2,...")
+@click.option(
+    "--grid-size",
+    default=0.1,
+    show_default=True,
+    help="Size in degrees of the density grid cells.",
+)
+def region(mnc_csv, mobile_site_gps_csv, bbox, polygon, grid_size):
+    """Print site counts and density over a bounding box or a polygon."""
+    import asyncio
+
+    from .application_router import ApplicationRouterBuilder
+    from .site_index import InvalidRegion, parse_bbox, parse_polygon
+
+    if (bbox is None) == (polygon is None):
+        raise click.UsageError("exactly one of --bbox and --polygon is required")
+    if not math.isfinite(grid_size) or grid_size <= 0:
+        raise click.BadParameter("must be a positive number", param_hint="--grid-size")
+    try:
+        region = parse_bbox(bbox) if bbox else parse_polygon(polygon)
+    except InvalidRegion:
+        raise click.BadParameter(
+            "invalid region", param_hint="--bbox" if bbox else "--polygon"
+        )
+    builder = ApplicationRouterBuilder(mnc_csv, mobile_site_gps_csv)
+    asyncio.run(builder.load_dataset())
+    click.echo(builder.region_coverage(region, grid_size).model_dump_json(indent=2))
+
+
+@cli.command()
+@click.argument("mnc_csv", type=click.Path(exists=True))
+@click.argument("mobile_site_gps_csv", type=click.Path(exists=True))
+@click.argument("request_log", type=click.Path(exists=True))
+@click.option(
+    "--output",
+    type=click.File("w"),
+    default="-",
+    show_default=True,
+    help="File receiving the folded stacks.",
+)
+@click.option(
+    "--interval",
+    default=0.001,
+    show_default=True,
+    help="Seconds between two stack samples.",
+)
+@geocoder_options
+@async_cmd
+async def profile(
+    mnc_csv,
+    mobile_site_gps_csv,
+    request_log,
+    output,
+    interval,
+    **geocoder_kwargs,
+):
+    """Profile the searches of a JSONL request log against the app in process.
+
+    The sampled stacks are written folded, ready for flamegraph.pl or
+    speedscope.
+    """
+    from .application_router import ApplicationRouterBuilder
+    from .profiling import profile_requests
+    from .request_log import read_request_log
+
+    requests = read_request_log(request_log)
+    builder = ApplicationRouterBuilder(
+        mnc_csv,
+        mobile_site_gps_csv,
+        geocoder=make_geocoder(**geocoder_kwargs),
+    )
+    try:
+        await builder.load()
+        if builder.startup_error is not None:
+            raise click.ClickException(f"startup failed: {builder.startup_error}")
+        sampler, statuses = await profile_requests(
+            builder.build_app(), requests, interval
+        )
+    finally:
+        await builder.geocoder.close()
+    output.write(sampler.folded())
+    click.echo(
+        f"replayed {len(requests)} searches, status: "
+        + " ".join(f"{status}={count}" for status, count in sorted(statuses.items())),
+        err=True,
+    )
+
+
 @cli.command()
 @click.argument("input", type=click.Path(exists=True))
 @click.argument("output", type=click.Path())
 def generate(input, output):
     """Generate mobile site from lamber 93 coordinates to GPS."""
-    mobile_sites = read_mobile_site(input)
-    with open(output, "w", newline="") as f:
-        mobile_site_csv_writter = csv.writer(f, delimiter=" ", quotechar='"')
-        for mobile_site in mobile_sites:
-            mobile_site = convert_lanbert93_to_gps(mobile_site)
-            mobile_site_csv_writter.writerow(
-                [
-                    mobile_site.provider,
-                    mobile_site.gps[0],
-                    mobile_site.gps[1],
-                    mobile_site.has_2g,
-                    mobile_site.has_3g,
-                    mobile_site.has_4g,
-                ]
+    from .mobile_site import (
+        convert_lanbert93_to_gps,
+        read_mobile_site,
+        write_mobile_site_gps,
+    )
+
+    write_mobile_site_gps(
+        output,
+        (
+            convert_lanbert93_to_gps(mobile_site)
+            for mobile_site in read_mobile_site(input)
+        ),
+    )
+
+
+@cli.command()
+@click.argument("old", type=click.Path(exists=True))
+@click.argument("new", type=click.Path(exists=True))
+@click.argument("output", type=click.Path())
+def diff(old, new, output):
+    """Write the differences between two mobile site exports."""
+    from .mobile_site import read_mobile_site
+    from .mobile_site_diff import diff_mobile_sites, write_mobile_site_diff
+
+    mobile_site_diff = diff_mobile_sites(read_mobile_site(old), read_mobile_site(new))
+    write_mobile_site_diff(output, mobile_site_diff)
+    changed = mobile_site_diff.changed_count()
+    click.echo(
+        f"{len(mobile_site_diff.removed) - changed} removed, "
+        f"{len(mobile_site_diff.added) - changed} added, {changed} changed"
+    )
+
+
+@cli.command()
+@click.argument("mobile_site_gps_csv", type=click.Path(exists=True))
+@click.argument("diff", type=click.Path(exists=True))
+def apply(mobile_site_gps_csv, diff):
+    """Apply a diff written by the diff command to a GPS mobile site file."""
+    from .mobile_site_diff import (
+        apply_mobile_site_diff_to_gps_csv,
+        convert_mobile_site_diff,
+        read_mobile_site_diff,
+    )
+
+    apply_mobile_site_diff_to_gps_csv(
+        mobile_site_gps_csv,
+        convert_mobile_site_diff(read_mobile_site_diff(diff)),
+    )
+
+
+@cli.command()
+@click.argument("ban_csv", type=click.Path(exists=True))
+@click.argument("index", type=click.Path())
+def build_geocoder_index(ban_csv, index):
+    """Build a local geocoder index from a BAN addresses export."""
+    from .geocoder import build_local_geocoder_index
+
+    count = build_local_geocoder_index(ban_csv, index)
+    click.echo(f"indexed {count} addresses in {index}")
+
+
+@cli.command()
+@click.argument("request_log", type=click.Path(exists=True))
+@geocoder_options
+@click.option("--concurrency", default=8, show_default=True)
+@async_cmd
+async def warm_cache(request_log, concurrency, **geocoder_kwargs):
+    """Pre-warm the geocode cache with the searches of a JSONL request log."""
+    import asyncio
+
+    from .address_api import AddressAPIError
+    from .geocode_cache import normalize_search
+    from .geocoder import GeocoderError
+    from .request_log import read_request_log
+
+    if geocoder_kwargs["geocode_cache"] is None:
+        raise click.UsageError("--geocode-cache is required")
+    geocoder = make_geocoder(**geocoder_kwargs)
+    searches = {
+        normalize_search(request.search) for request in read_request_log(request_log)
+    }
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def warm(search):
+        nonlocal failures
+        async with semaphore:
+            try:
+                await geocoder.geocode(search)
+            except (AddressAPIError, GeocoderError) as ex:
+                logger.error("could not geocode {}: {}".format(search, ex))
+                failures += 1
+
+    try:
+        await asyncio.gather(*(warm(search) for search in searches))
+    finally:
+        await geocoder.close()
+    click.echo(f"warmed {len(searches) - failures}/{len(searches)} searches")
+
+
+@cli.command()
+@click.argument("request_log", type=click.Path(exists=True))
+@click.option("--url", default="http://127.0.0.1:5000", show_default=True)
+@click.option(
+    "--rps",
+    type=float,
+    help="Send searches at this rate instead of keeping --concurrency in flight.",
+)
+@click.option("--concurrency", default=8, show_default=True)
+@click.option(
+    "--duration",
+    type=float,
+    help="Replay the log in a loop for this many seconds instead of once.",
+)
+@click.option("--timeout", default=10.0, show_default=True)
+@click.option(
+    "--stub-fixture",
+    type=click.Path(exists=True),
+    help="Serve this address API response from a local stub during the test.",
+)
+@click.option("--stub-port", default=8765, show_default=True)
+@click.option(
+    "--stub-latency",
+    default=0.0,
+    show_default=True,
+    help="Seconds the stub waits before answering.",
+)
+@click.option("--stub-error-rate", default=0.0, show_default=True)
+@click.option("--json", "as_json", is_flag=True, help="Print the results as JSON.")
+@async_cmd
+async def loadtest(
+    request_log,
+    url,
+    rps,
+    concurrency,
+    duration,
+    timeout,
+    stub_fixture,
+    stub_port,
+    stub_latency,
+    stub_error_rate,
+    as_json,
+):
+    """Replay the searches of a JSONL request log against a running server.
+
+    With --stub-fixture, point the server to the stub with
+    --address-api-url http://127.0.0.1:STUB_PORT.
+    """
+    import json
+
+    from .loadtest import LoadTest
+    from .request_log import read_request_log
+
+    stub = None
+    if stub_fixture is not None:
+        from .address_api_stub import AddressAPIStub
+
+        with open(stub_fixture) as f:
+            stub = AddressAPIStub(
+                f.read(), latency=stub_latency, error_rate=stub_error_rate
             )
+        click.echo(
+            f"address API stub listening on {await stub.start(port=stub_port)}",
+            err=True,
+        )
+    try:
+        result = await LoadTest(
+            url,
+            read_request_log(request_log),
+            rps=rps,
+            concurrency=concurrency,
+            duration=duration,
+            timeout=timeout,
+        ).run()
+    finally:
+        if stub is not None:
+            await stub.stop()
+    click.echo(json.dumps(result.summary(), indent=2) if as_json else result.report())
 
 
 if __name__ == "__main__":
+    import asyncio
+
     asyncio.run(cli())
@@ -2,6 +2,7 @@ import csv
 import logging
 from collections import defaultdict
 from dataclasses import dataclass
+from typing import Iterable, Iterator
 
 from paperless_bt.coordinates import compute_haversine, lamber93_to_gps
 
@@ -92,6 +93,25 @@ def read_mobile_site_gps(filename: str) -> list[MobileSiteGPS]:
     return res
 
 
+def write_mobile_site_gps(
+    filename: str,
+    mobile_sites: Iterable[MobileSiteGPS],
+) -> None:
+    with open(filename, "w", newline="") as f:
+        mobile_site_csv_writter = csv.writer(f, delimiter=" ", quotechar='"')
+        for mobile_site in mobile_sites:
+            mobile_site_csv_writter.writerow(
+                [
+                    mobile_site.provider,
+                    mobile_site.gps[0],
+                    mobile_site.gps[1],
+                    mobile_site.has_2g,
+                    mobile_site.has_3g,
+                    mobile_site.has_4g,
+                ]
+            )
+
+
 @dataclass
 class BrandMobileCodes:
     mcc: int
@@ -158,13 +178,32 @@ def convert_lanbert93_to_gps(mobile_site: MobileSite) -> MobileSiteGPS:
     )
 
 
-def filter_reachable_mobile_sites(
+@dataclass
+class ReachableMobileSite:
+    protocol: str
+    distance: float
+    mobile_site: MobileSiteGPS
+
+    def sort_key(self) -> tuple[float, str, str, float, float]:
+        """Order on reachable sites, nearest first.
+
+        Ties on distance are broken by provider, protocol and coordinates, so
+        only duplicated sites have equal keys.
+        """
+        return (
+            self.distance,
+            self.mobile_site.provider,
+            self.protocol,
+            self.mobile_site.gps[0],
+            self.mobile_site.gps[1],
+        )
+
+
+def iter_reachable_mobile_sites(
     position: tuple[float, float],
-    mobile_sites: list[MobileSiteGPS],
-) -> dict[str, dict[str, list[MobileSiteGPS]]]:
-    res: dict[str, dict[str, list[MobileSiteGPS]]] = defaultdict(
-        lambda: defaultdict(list)
-    )
+    mobile_sites: Iterable[MobileSiteGPS],
+) -> Iterator[ReachableMobileSite]:
+    """Yield every (site, protocol) reachable from position, in scan order."""
     for mobile_site in mobile_sites:
         distance = compute_haversine(
             position[0],
@@ -173,9 +212,48 @@ def filter_reachable_mobile_sites(
             mobile_site.gps[1],
         )
         if distance < 30e3 and mobile_site.has_2g:
-            res[mobile_site.provider]["2g"].append(mobile_site)
+            yield ReachableMobileSite("2g", distance, mobile_site)
         if distance < 5e3 and mobile_site.has_3g:
-            res[mobile_site.provider]["3g"].append(mobile_site)
+            yield ReachableMobileSite("3g", distance, mobile_site)
         if distance < 10e3 and mobile_site.has_4g:
-            res[mobile_site.provider]["4g"].append(mobile_site)
+            yield ReachableMobileSite("4g", distance, mobile_site)
+
+
+def limit_reachable_mobile_sites(
+    reachable_sites: Iterable[ReachableMobileSite],
+    limit: int,
+) -> Iterator[ReachableMobileSite]:
+    """Keep at most limit sites per provider/protocol, in input order."""
+    seen: dict[tuple[str, str], int] = defaultdict(int)
+    for reachable_site in reachable_sites:
+        key = (reachable_site.mobile_site.provider, reachable_site.protocol)
+        if seen[key] >= limit:
+            continue
+        seen[key] += 1
+        yield reachable_site
+
+
+def group_reachable_mobile_sites(
+    reachable_sites: Iterable[ReachableMobileSite],
+) -> dict[str, dict[str, list[MobileSiteGPS]]]:
+    res: dict[str, dict[str, list[MobileSiteGPS]]] = defaultdict(
+        lambda: defaultdict(list)
+    )
+    for reachable_site in reachable_sites:
+        res[reachable_site.mobile_site.provider][reachable_site.protocol].append(
+            reachable_site.mobile_site
+        )
     return res
+
+
+# 2g has the widest range, no site further than this is reachable
+MAX_REACHABLE_DISTANCE = 30e3
+
+
+def filter_reachable_mobile_sites(
+    position: tuple[float, float],
+    mobile_sites: list[MobileSiteGPS],
+) -> dict[str, dict[str, list[MobileSiteGPS]]]:
+    return group_reachable_mobile_sites(
+        iter_reachable_mobile_sites(position, mobile_sites)
+    )
@@ -0,0 +1,210 @@
+import csv
+import logging
+import os
+from collections import Counter
+from dataclasses import dataclass, field
+
+from .coordinates import lamber93_to_gps
+from .mobile_site import (
+    MobileSite,
+    MobileSiteGPS,
+    mobile_site_row_to_mobilesite,
+    read_mobile_site_gps,
+    write_mobile_site_gps,
+)
+
+logger = logging.getLogger(__name__)
+
+MobileSiteRow = tuple[str, int, int, bool, bool, bool]
+
+
+class MobileSiteDiffFormatError(Exception):
+    pass
+
+
+class MobileSiteDiffError(Exception):
+    pass
+
+
+@dataclass
+class MobileSiteDiff:
+    """Sites to remove and to add to go from a site export to the next one.
+
+    A site whose technologies changed is removed then added again with the
+    same (operator, x, y) key.
+    """
+
+    removed: list[MobileSite] = field(default_factory=list)
+    added: list[MobileSite] = field(default_factory=list)
+
+    def changed_keys(self) -> set[tuple[str, tuple[int, int]]]:
+        removed_keys = {(site.provider, site.lambert93) for site in self.removed}
+        return {
+            (site.provider, site.lambert93)
+            for site in self.added
+            if (site.provider, site.lambert93) in removed_keys
+        }
+
+    def changed_count(self) -> int:
+        """Number of sites removed then added again, keys being duplicated."""
+        removed = Counter((site.provider, site.lambert93) for site in self.removed)
+        added = Counter((site.provider, site.lambert93) for site in self.added)
+        return sum((removed & added).values())
+
+
+@dataclass
+class MobileSiteGPSDiff:
+    removed: list[MobileSiteGPS] = field(default_factory=list)
+    added: list[MobileSiteGPS] = field(default_factory=list)
+
+
+def mobile_site_to_row(mobile_site: MobileSite) -> MobileSiteRow:
+    return (
+        mobile_site.provider,
+        mobile_site.lambert93[0],
+        mobile_site.lambert93[1],
+        mobile_site.has_2g,
+        mobile_site.has_3g,
+        mobile_site.has_4g,
+    )
+
+
+def row_to_mobile_site(row: MobileSiteRow) -> MobileSite:
+    provider, x, y, has_2g, has_3g, has_4g = row
+    return MobileSite(
+        provider=provider,
+        lambert93=(x, y),
+        has_2g=has_2g,
+        has_3g=has_3g,
+        has_4g=has_4g,
+    )
+
+
+def diff_mobile_sites(
+    old: list[MobileSite],
+    new: list[MobileSite],
+) -> MobileSiteDiff:
+    # exports contain duplicated rows, so compare them as multisets
+    old_rows = Counter(mobile_site_to_row(mobile_site) for mobile_site in old)
+    new_rows = Counter(mobile_site_to_row(mobile_site) for mobile_site in new)
+    return MobileSiteDiff(
+        removed=[
+            row_to_mobile_site(row) for row in sorted((old_rows - new_rows).elements())
+        ],
+        added=[
+            row_to_mobile_site(row) for row in sorted((new_rows - old_rows).elements())
+        ],
+    )
+
+
+def write_mobile_site_diff(filename: str, diff: MobileSiteDiff) -> None:
+    """Write the diff as the site export format prefixed by a - or + column."""
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(["Op", "Operateur", "x", "y", "2G", "3G", "4G"])
+        for op, mobile_sites in (("-", diff.removed), ("+", diff.added)):
+            for mobile_site in mobile_sites:
+                writer.writerow(
+                    [
+                        op,
+                        mobile_site.provider,
+                        mobile_site.lambert93[0],
+                        mobile_site.lambert93[1],
+                        int(mobile_site.has_2g),
+                        int(mobile_site.has_3g),
+                        int(mobile_site.has_4g),
+                    ]
+                )
+
+
+def read_mobile_site_diff(filename: str) -> MobileSiteDiff:
+    diff = MobileSiteDiff()
+    with open(filename, newline="") as csvfile:
+        reader = csv.reader(csvfile, delimiter=";")
+        # ignore headers
+        if next(reader, None) is None:
+            raise MobileSiteDiffFormatError
+        for row in reader:
+            try:
+                op = row[0]
+                mobile_site = mobile_site_row_to_mobilesite(row[1:])
+            except (IndexError, ValueError):
+                logger.error("incorrect row: {}".format(row))
+                raise MobileSiteDiffFormatError
+            if op == "-":
+                diff.removed.append(mobile_site)
+            elif op == "+":
+                diff.added.append(mobile_site)
+            else:
+                logger.error("incorrect row: {}".format(row))
+                raise MobileSiteDiffFormatError
+    return diff
+
+
+def convert_mobile_site_diff(diff: MobileSiteDiff) -> MobileSiteGPSDiff:
+    """Convert the diff to GPS, converting each (operator, x, y) key once.
+
+    Removed sites are converted too: it's the only way to find them in the
+    GPS dataset, which does not keep lambert 93 coordinates.
+    """
+    gps_by_lambert93: dict[tuple[int, int], tuple[float, float]] = {}
+
+    def to_gps(mobile_site: MobileSite) -> MobileSiteGPS:
+        if mobile_site.lambert93 not in gps_by_lambert93:
+            gps_by_lambert93[mobile_site.lambert93] = lamber93_to_gps(
+                *mobile_site.lambert93
+            )
+        return MobileSiteGPS(
+            provider=mobile_site.provider,
+            gps=gps_by_lambert93[mobile_site.lambert93],
+            has_2g=mobile_site.has_2g,
+            has_3g=mobile_site.has_3g,
+            has_4g=mobile_site.has_4g,
+        )
+
+    return MobileSiteGPSDiff(
+        removed=[to_gps(mobile_site) for mobile_site in diff.removed],
+        added=[to_gps(mobile_site) for mobile_site in diff.added],
+    )
+
+
+def patch_mobile_sites_gps(
+    mobile_sites: list[MobileSiteGPS],
+    diff: MobileSiteGPSDiff,
+) -> list[MobileSiteGPS]:
+    """Return mobile_sites without the removed sites and with the added ones."""
+    to_remove = Counter(
+        (site.provider, site.gps, site.has_2g, site.has_3g, site.has_4g)
+        for site in diff.removed
+    )
+    res = []
+    for mobile_site in mobile_sites:
+        key = (
+            mobile_site.provider,
+            mobile_site.gps,
+            mobile_site.has_2g,
+            mobile_site.has_3g,
+            mobile_site.has_4g,
+        )
+        if to_remove[key] > 0:
+            to_remove[key] -= 1
+        else:
+            res.append(mobile_site)
+    missing = +to_remove
+    if missing:
+        raise MobileSiteDiffError(
+            f"{sum(missing.values())} removed sites are not in the dataset"
+        )
+    res.extend(diff.added)
+    return res
+
+
+def apply_mobile_site_diff_to_gps_csv(
+    filename: str,
+    diff: MobileSiteGPSDiff,
+) -> None:
+    patched = patch_mobile_sites_gps(read_mobile_site_gps(filename), diff)
+    # write then rename so a running reader never sees a partial file
+    tmp_filename = f"{filename}.tmp"
+    write_mobile_site_gps(tmp_filename, patched)
+    os.replace(tmp_filename, filename)
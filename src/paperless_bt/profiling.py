@@ -0,0 +1,228 @@
+import asyncio
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from types import FrameType
+from typing import Callable, TypeVar
+
+from fastapi import FastAPI, Response
+from fastapi.responses import PlainTextResponse
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .request_log import LoggedRequest, request_query_string
+
+T = TypeVar("T")
+
+# set while a request is profiled: its work is then kept on the profiled
+# thread instead of being handed to the thread pool
+profiled: ContextVar[bool] = ContextVar("profiled", default=False)
+
+PROFILE_HEADER = "X-Profile"
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+
+async def run_in_thread(func: Callable[..., T], *args) -> T:
+    if profiled.get():
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+
+def frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_qualname}"
+
+
+def fold_stack(frame: FrameType | None) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class StackSampler:
+    """Sample the stack of a thread at a fixed interval.
+
+    The samples are written as folded stacks, one "frame;frame;... count"
+    line per distinct stack, the input of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval: float = 0.001, thread_id: int | None = None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks: Counter[str] = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[fold_stack(frame)] += 1
+
+    def __enter__(self) -> "StackSampler":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def folded(self) -> str:
+        return "".join(
+            f"{stack} {count}\n" for stack, count in sorted(self.stacks.items())
+        )
+
+
+def pstats_report(profiler: cProfile.Profile, limit: int = 50) -> str:
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+class ProfilingMiddleware:
+    """Let admins profile a single request by sending an X-Profile header.
+
+    "X-Profile: cprofile" answers the cProfile statistics of the request
+    and "X-Profile: sample" its sampled folded stacks, instead of its
+    response. The X-Admin-Token header must match admin_token. Requests
+    running concurrently on the event loop show up in the profile as well.
+    """
+
+    def __init__(self, app: ASGIApp, admin_token: str):
+        self.app = app
+        self.admin_token = admin_token
+        # a thread has a single profiler at a time
+        self.busy = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or PROFILE_HEADER not in Headers(scope=scope):
+            await self.app(scope, receive, send)
+            return
+        await self.profile(scope, receive, send)
+
+    def check(self, headers: Headers) -> Response | None:
+        """Return the response refusing to profile the request, if any."""
+        if not hmac.compare_digest(
+            headers.get(ADMIN_TOKEN_HEADER, ""), self.admin_token
+        ):
+            return PlainTextResponse("Forbidden.", status_code=403)
+        if headers[PROFILE_HEADER] not in ("cprofile", "sample"):
+            return PlainTextResponse(
+                f"{PROFILE_HEADER} must be cprofile or sample.", status_code=400
+            )
+        if self.busy:
+            return PlainTextResponse(
+                "Another request is being profiled.", status_code=409
+            )
+        return None
+
+    async def profile(self, scope: Scope, receive: Receive, send: Send) -> None:
+        headers = Headers(scope=scope)
+        refusal = self.check(headers)
+        if refusal is not None:
+            await refusal(scope, receive, send)
+            return
+
+        status = 0
+
+        # the whole response, streamed ones included, is produced under the
+        # profiler so that serialization shows up, and then dropped
+        async def discard(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        self.busy = True
+        token = profiled.set(True)
+        try:
+            if headers[PROFILE_HEADER] == "cprofile":
+                profiler = cProfile.Profile()
+                with profiler:
+                    await self.app(scope, receive, discard)
+                report = pstats_report(profiler)
+            else:
+                with StackSampler() as sampler:
+                    await self.app(scope, receive, discard)
+                report = sampler.folded()
+        finally:
+            profiled.reset(token)
+            self.busy = False
+        await PlainTextResponse(report, headers={"X-Profiled-Status": str(status)})(
+            scope, receive, send
+        )
+
+
+def add_profiling(app: FastAPI, admin_token: str | None) -> None:
+    """Install ProfilingMiddleware, only when an admin token is configured."""
+    if admin_token is not None:
+        app.add_middleware(ProfilingMiddleware, admin_token=admin_token)
+
+
+async def asgi_get(
+    app: FastAPI,
+    path: str,
+    query_string: str = "",
+    headers: dict[str, str] | None = None,
+) -> tuple[int, bytes]:
+    """Send a GET request to app in process, return its status and body."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query_string.encode(),
+        "root_path": "",
+        "headers": [
+            (name.lower().encode(), value.encode())
+            for name, value in (headers or {}).items()
+        ],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+    status = 0
+    body = bytearray()
+
+    async def receive() -> Message:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: Message) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            body.extend(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status, bytes(body)
+
+
+async def profile_requests(
+    app: FastAPI,
+    requests: list[LoggedRequest],
+    interval: float = 0.001,
+) -> tuple[StackSampler, Counter[int]]:
+    """Replay requests one after the other against app under a StackSampler.
+
+    Return the sampler and the count of responses by status.
+    """
+    statuses: Counter[int] = Counter()
+    token = profiled.set(True)
+    try:
+        with StackSampler(interval) as sampler:
+            for request in requests:
+                status, _ = await asgi_get(app, "/", request_query_string(request))
+                statuses[status] += 1
+    finally:
+        profiled.reset(token)
+    return sampler, statuses
@@ -0,0 +1,50 @@
+import json
+import logging
+from dataclasses import dataclass
+from urllib.parse import urlencode
+
+logger = logging.getLogger(__name__)
+
+
+class RequestLogFormatError(Exception):
+    pass
+
+
+@dataclass
+class LoggedRequest:
+    search: str
+    full: bool = False
+
+
+def logged_request_from_json(line: str) -> LoggedRequest:
+    entry = json.loads(line)
+    search = entry.get("search", entry.get("q"))
+    if not isinstance(search, str):
+        raise ValueError("missing search")
+    return LoggedRequest(search=search, full=bool(entry.get("full", False)))
+
+
+def request_query_string(request: LoggedRequest) -> str:
+    """Query string sending request to the search route."""
+    return urlencode({"search": request.search, "full": str(request.full).lower()})
+
+
+def read_request_log(filename: str) -> list[LoggedRequest]:
+    """Read a JSONL request log, one {"search": ..., "full": ...} per line.
+
+    "q" is accepted as an alias of "search" so that raw query strings logs
+    can be replayed as well.
+    """
+    res = []
+    with open(filename) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                res.append(logged_request_from_json(line))
+            except (AttributeError, ValueError):
+                logger.error("incorrect line: {}".format(line))
+                raise RequestLogFormatError
+    if res == []:
+        raise RequestLogFormatError
+    return res
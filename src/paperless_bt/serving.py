@@ -0,0 +1,267 @@
+import gc
+import logging
+import os
+import random
+import select
+import signal
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class WorkerMemory:
+    rss: int
+    pss: int
+    shared: int
+    private: int
+
+
+def read_worker_memory(pid: int) -> WorkerMemory:
+    """Read the memory of a process from /proc, in bytes.
+
+    pss splits shared pages between the processes mapping them, so the sum
+    of the workers pss is what the pool really costs.
+    """
+    fields: dict[str, int] = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    return WorkerMemory(
+        rss=fields.get("Rss", 0),
+        pss=fields.get("Pss", 0),
+        shared=fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+        private=fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    )
+
+
+def notify_started(server: uvicorn.Server, started_fd: int) -> None:
+    """Write to started_fd once server serves, from a worker thread."""
+    while not server.started:
+        if server.should_exit:
+            return
+        time.sleep(0.01)
+    try:
+        os.write(started_fd, b"1")
+    except OSError:
+        # the main process did not wait for this worker
+        pass
+    finally:
+        os.close(started_fd)
+
+
+class PreforkServer:
+    """Serve an already built ASGI app from several forked uvicorn workers.
+
+    Everything loaded before run() (the dataset, its indexes) is shared
+    copy-on-write by the workers instead of being loaded again by each of
+    them. A worker exits after about max_requests requests and is replaced,
+    SIGHUP calls on_reload, if any, in the main process then replaces all
+    the workers one by one, so they are forked with what it updated.
+    SIGUSR1 logs their memory.
+    """
+
+    def __init__(
+        self,
+        app,
+        host: str = "127.0.0.1",
+        port: int = 5000,
+        workers: int = 2,
+        max_requests: int | None = None,
+        max_requests_jitter: int = 0,
+        memory_report_interval: float | None = 60.0,
+        log_level: str = "info",
+        on_reload: Callable[[], object] | None = None,
+        start_timeout: float = 30.0,
+    ):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.memory_report_interval = memory_report_interval
+        self.log_level = log_level
+        self.on_reload = on_reload
+        self.start_timeout = start_timeout
+        self.worker_pids: set[int] = set()
+        self.stopping = False
+        self.recycle_requested = False
+        self.memory_report_requested = False
+
+    def bind(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(2048)
+        sock.set_inheritable(True)
+        return sock
+
+    def worker_max_requests(self) -> int | None:
+        # jitter so that workers started together are not recycled together
+        if self.max_requests is None:
+            return None
+        return self.max_requests + random.randint(0, self.max_requests_jitter)
+
+    def wait_started(self, pid: int, started_fd: int) -> None:
+        readable, _, _ = select.select([started_fd], [], [], self.start_timeout)
+        if not readable:
+            logger.warning(
+                "worker {} not started after {}s".format(pid, self.start_timeout)
+            )
+        elif os.read(started_fd, 1) != b"1":
+            logger.warning("worker {} exited before starting".format(pid))
+
+    def spawn_worker(self, sock: socket.socket, wait_started: bool = False) -> int:
+        """Fork a worker, waiting until it serves requests if wait_started."""
+        max_requests = self.worker_max_requests()
+        started_read, started_write = os.pipe()
+        pid = os.fork()
+        if pid != 0:
+            os.close(started_write)
+            self.worker_pids.add(pid)
+            logger.info("started worker {}".format(pid))
+            try:
+                if wait_started:
+                    self.wait_started(pid, started_read)
+            finally:
+                os.close(started_read)
+            return pid
+        os.close(started_read)
+        exit_code = 0
+        try:
+            for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            config = uvicorn.Config(
+                self.app,
+                log_level=self.log_level,
+                limit_max_requests=max_requests,
+            )
+            server = uvicorn.Server(config)
+            threading.Thread(
+                target=notify_started,
+                args=(server, started_write),
+                daemon=True,
+            ).start()
+            server.run(sockets=[sock])
+        except BaseException:
+            logger.exception("worker {} crashed".format(os.getpid()))
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def report_memory(self) -> None:
+        total_pss = 0
+        for pid in sorted(self.worker_pids):
+            try:
+                memory = read_worker_memory(pid)
+            except OSError:
+                continue
+            total_pss += memory.pss
+            logger.info(
+                "worker {}: rss={:.1f}MiB pss={:.1f}MiB shared={:.1f}MiB "
+                "private={:.1f}MiB".format(
+                    pid,
+                    memory.rss / 2**20,
+                    memory.pss / 2**20,
+                    memory.shared / 2**20,
+                    memory.private / 2**20,
+                )
+            )
+        logger.info("workers total pss={:.1f}MiB".format(total_pss / 2**20))
+
+    def reap_workers(self) -> None:
+        while self.worker_pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.worker_pids.clear()
+                return
+            if pid == 0:
+                return
+            if pid in self.worker_pids:
+                self.worker_pids.discard(pid)
+                logger.info(
+                    "worker {} exited with {}".format(
+                        pid, os.waitstatus_to_exitcode(status)
+                    )
+                )
+
+    def recycle_workers(self, sock: socket.socket) -> None:
+        # an old worker is only stopped once its replacement serves, so the
+        # capacity never drops below workers
+        for pid in list(self.worker_pids):
+            if self.stopping:
+                return
+            self.spawn_worker(sock, wait_started=True)
+            self.terminate(pid)
+
+    def terminate(self, pid: int) -> None:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            self.worker_pids.discard(pid)
+
+    def handle_signal(self, signum, frame) -> None:
+        if signum == signal.SIGHUP:
+            self.recycle_requested = True
+        elif signum == signal.SIGUSR1:
+            self.memory_report_requested = True
+        else:
+            self.stopping = True
+
+    def run(self) -> None:
+        sock = self.bind()
+        logger.info(
+            "listening on http://{}:{} with {} workers".format(
+                self.host, self.port, self.workers
+            )
+        )
+        # objects allocated so far are never collected, so the collector
+        # does not write to their pages and break copy-on-write sharing
+        gc.freeze()
+        for signum in (
+            signal.SIGTERM,
+            signal.SIGINT,
+            signal.SIGHUP,
+            signal.SIGUSR1,
+        ):
+            signal.signal(signum, self.handle_signal)
+        last_memory_report = time.monotonic()
+        try:
+            while not self.stopping:
+                self.reap_workers()
+                while len(self.worker_pids) < self.workers:
+                    self.spawn_worker(sock)
+                if self.recycle_requested:
+                    self.recycle_requested = False
+                    if self.on_reload is not None:
+                        self.on_reload()
+                    self.recycle_workers(sock)
+                if self.memory_report_requested or (
+                    self.memory_report_interval is not None
+                    and time.monotonic() - last_memory_report
+                    > self.memory_report_interval
+                ):
+                    self.memory_report_requested = False
+                    last_memory_report = time.monotonic()
+                    self.report_memory()
+                time.sleep(0.1)
+        finally:
+            for pid in list(self.worker_pids):
+                self.terminate(pid)
+            for pid in list(self.worker_pids):
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self.worker_pids.clear()
+            sock.close()
@@ -0,0 +1,304 @@
+import math
+from collections import defaultdict
+from dataclasses import dataclass
+from itertools import chain
+from typing import Iterable, Iterator
+
+from .coordinates import EARTH_RADIUS
+from .mobile_site import MobileSiteGPS
+from .mobile_site_diff import MobileSiteGPSDiff
+
+Cell = tuple[int, int]
+Point = tuple[float, float]
+Polygon = list[Point]
+
+
+class MobileSiteNotIndexed(Exception):
+    pass
+
+
+class InvalidRegion(Exception):
+    pass
+
+
+def parse_coordinates(value: str) -> list[float]:
+    try:
+        return [float(coordinate) for coordinate in value.split(",")]
+    except ValueError:
+        raise InvalidRegion(value)
+
+
+def parse_points(value: str) -> list[Point]:
+    """Parse "x1,y1,x2,y2,..." into longitude, latitude points.
+
+    Points out of [-180, 180] x [-90, 90], NaN and infinities included, are
+    refused: the cost of a region grows with its extent.
+    """
+    coordinates = parse_coordinates(value)
+    if len(coordinates) % 2 != 0:
+        raise InvalidRegion(value)
+    points = list(zip(coordinates[::2], coordinates[1::2]))
+    for x, y in points:
+        if not (-180 <= x <= 180 and -90 <= y <= 90):
+            raise InvalidRegion(value)
+    return points
+
+
+def parse_bbox(value: str) -> Polygon:
+    """Parse "min_x,min_y,max_x,max_y" into the polygon of the box."""
+    points = parse_points(value)
+    if len(points) != 2:
+        raise InvalidRegion(value)
+    (min_x, min_y), (max_x, max_y) = points
+    if min_x >= max_x or min_y >= max_y:
+        raise InvalidRegion(value)
+    return [(min_x, min_y), (max_x, min_y), (max_x, max_y), (min_x, max_y)]
+
+
+def parse_polygon(value: str) -> Polygon:
+    """Parse "x1,y1,x2,y2,..." into a polygon of at least 3 vertices."""
+    points = parse_points(value)
+    if len(points) < 3:
+        raise InvalidRegion(value)
+    return points
+
+
+def point_in_polygon(point: Point, polygon: Polygon) -> bool:
+    """Ray casting: count the edges crossed by a ray going to +x from point."""
+    x, y = point
+    inside = False
+    previous_x, previous_y = polygon[-1]
+    for current_x, current_y in polygon:
+        if (current_y > y) != (previous_y > y) and x < (previous_x - current_x) * (
+            y - current_y
+        ) / (previous_y - current_y) + current_x:
+            inside = not inside
+        previous_x, previous_y = current_x, current_y
+    return inside
+
+
+@dataclass
+class RegionCoverage:
+    # provider -> protocol -> number of sites
+    site: dict[str, dict[str, int]]
+    # lower corner of the density grid cells -> number of sites
+    density: dict[Point, int]
+
+
+class MobileSiteIndex:
+    """Grid of mobile sites bucketed by cells of cell_size degrees.
+
+    Sites can be inserted and removed one by one, so dataset updates patch
+    the index instead of rebuilding it.
+    """
+
+    def __init__(
+        self,
+        mobile_sites: Iterable[MobileSiteGPS] = (),
+        cell_size: float = 0.1,
+    ):
+        self.cell_size = cell_size
+        self.cells: dict[Cell, list[MobileSiteGPS]] = defaultdict(list)
+        self.size = 0
+        for mobile_site in mobile_sites:
+            self.insert(mobile_site)
+
+    def cell(self, coordinates: tuple[float, float]) -> Cell:
+        return (
+            math.floor(coordinates[0] / self.cell_size),
+            math.floor(coordinates[1] / self.cell_size),
+        )
+
+    def insert(self, mobile_site: MobileSiteGPS) -> None:
+        self.cells[self.cell(mobile_site.gps)].append(mobile_site)
+        self.size += 1
+
+    def remove(self, mobile_site: MobileSiteGPS) -> None:
+        """Remove one site equal to mobile_site."""
+        cell = self.cell(mobile_site.gps)
+        sites = self.cells.get(cell, [])
+        try:
+            sites.remove(mobile_site)
+        except ValueError:
+            raise MobileSiteNotIndexed(mobile_site)
+        if not sites:
+            del self.cells[cell]
+        self.size -= 1
+
+    def apply_diff(self, diff: MobileSiteGPSDiff) -> None:
+        """Patch the index in place, leaving it untouched if diff doesn't apply."""
+        removed: list[MobileSiteGPS] = []
+        try:
+            for mobile_site in diff.removed:
+                self.remove(mobile_site)
+                removed.append(mobile_site)
+        except MobileSiteNotIndexed:
+            for mobile_site in removed:
+                self.insert(mobile_site)
+            raise
+        for mobile_site in diff.added:
+            self.insert(mobile_site)
+
+    def patched(self, diff: MobileSiteGPSDiff) -> "MobileSiteIndex":
+        """Return a copy of the index with diff applied, leaving self untouched.
+
+        Only the cells touched by diff are copied, the others are shared, so
+        the copy is cheap and searches can keep iterating self meanwhile.
+        """
+        index = MobileSiteIndex(cell_size=self.cell_size)
+        index.cells = defaultdict(list, self.cells)
+        index.size = self.size
+        for mobile_site in chain(diff.removed, diff.added):
+            cell = self.cell(mobile_site.gps)
+            if cell in self.cells and index.cells[cell] is self.cells[cell]:
+                index.cells[cell] = list(self.cells[cell])
+        index.apply_diff(diff)
+        return index
+
+    def bounds(self) -> tuple[Cell, Cell] | None:
+        """Lowest and highest cell coordinates holding sites, None if empty."""
+        if not self.cells:
+            return None
+        firsts = [first for first, _ in self.cells]
+        seconds = [second for _, second in self.cells]
+        return (min(firsts), min(seconds)), (max(firsts), max(seconds))
+
+    def boundary_cells(self, polygon: Polygon) -> set[Cell]:
+        """Cells of the index bounds crossed by the edges of polygon.
+
+        The edges are walked column by column, only over the bounds of the
+        index: the cells out of them hold no site.
+        """
+        res: set[Cell] = set()
+        bounds = self.bounds()
+        if bounds is None:
+            return res
+        (min_first, min_second), (max_first, max_second) = bounds
+        for (x0, y0), (x1, y1) in zip(polygon[-1:] + polygon[:-1], polygon):
+            if x0 > x1:
+                x0, y0, x1, y1 = x1, y1, x0, y0
+            first_start, _ = self.cell((x0, y0))
+            first_end, _ = self.cell((x1, y1))
+            for first in range(
+                max(first_start, min_first), min(first_end, max_first) + 1
+            ):
+                # part of the edge within the column
+                start_x = max(x0, first * self.cell_size)
+                end_x = min(x1, (first + 1) * self.cell_size)
+                if x1 == x0:
+                    start_y, end_y = y0, y1
+                else:
+                    slope = (y1 - y0) / (x1 - x0)
+                    start_y = y0 + (start_x - x0) * slope
+                    end_y = y0 + (end_x - x0) * slope
+                _, second_start = self.cell((start_x, min(start_y, end_y)))
+                _, second_end = self.cell((start_x, max(start_y, end_y)))
+                for second in range(
+                    max(second_start, min_second), min(second_end, max_second) + 1
+                ):
+                    res.add((first, second))
+        return res
+
+    def within(self, polygon: Polygon) -> Iterator[MobileSiteGPS]:
+        """Yield the sites inside polygon.
+
+        Cells not crossed by the boundary of the polygon are entirely inside
+        or outside of it and decided at once, only the sites of the crossed
+        cells are tested one by one.
+        """
+        bounds = self.bounds()
+        if bounds is None:
+            return
+        min_cell = self.cell((min(x for x, _ in polygon), min(y for _, y in polygon)))
+        max_cell = self.cell((max(x for x, _ in polygon), max(y for _, y in polygon)))
+        min_cell = (max(min_cell[0], bounds[0][0]), max(min_cell[1], bounds[0][1]))
+        max_cell = (min(max_cell[0], bounds[1][0]), min(max_cell[1], bounds[1][1]))
+        candidate_cells: Iterable[Cell]
+        # regions larger than the indexed area are cheaper to filter
+        if (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1) > len(
+            self.cells
+        ):
+            candidate_cells = [
+                (first, second)
+                for first, second in self.cells
+                if min_cell[0] <= first <= max_cell[0]
+                and min_cell[1] <= second <= max_cell[1]
+            ]
+        else:
+            candidate_cells = (
+                (first, second)
+                for first in range(min_cell[0], max_cell[0] + 1)
+                for second in range(min_cell[1], max_cell[1] + 1)
+            )
+        crossed_cells = self.boundary_cells(polygon)
+        for first, second in candidate_cells:
+            sites = self.cells.get((first, second))
+            if not sites:
+                continue
+            if (first, second) in crossed_cells:
+                yield from (
+                    site for site in sites if point_in_polygon(site.gps, polygon)
+                )
+            # the boundary doesn't cross the cell, its center tells for all
+            elif point_in_polygon(
+                ((first + 0.5) * self.cell_size, (second + 0.5) * self.cell_size),
+                polygon,
+            ):
+                yield from sites
+
+    def coverage(self, polygon: Polygon, grid_size: float) -> RegionCoverage:
+        """Count the sites inside polygon by provider/protocol and grid cell."""
+        site: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        density: dict[Point, int] = defaultdict(int)
+        for mobile_site in self.within(polygon):
+            for protocol, has_protocol in (
+                ("2g", mobile_site.has_2g),
+                ("3g", mobile_site.has_3g),
+                ("4g", mobile_site.has_4g),
+            ):
+                if has_protocol:
+                    site[mobile_site.provider][protocol] += 1
+            density[
+                (
+                    round(math.floor(mobile_site.gps[0] / grid_size) * grid_size, 9),
+                    round(math.floor(mobile_site.gps[1] / grid_size) * grid_size, 9),
+                )
+            ] += 1
+        return RegionCoverage(site=site, density=density)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[MobileSiteGPS]:
+        for sites in self.cells.values():
+            yield from sites
+
+    def near(
+        self,
+        position: tuple[float, float],
+        distance: float,
+    ) -> Iterator[MobileSiteGPS]:
+        """Yield a superset of the sites closer than distance from position.
+
+        The bounds follow compute_haversine, which takes the first coordinate
+        as its latitude: the first coordinate can't differ by more than the
+        angle of distance, the second one by more than that angle widened by
+        the cosine of the first.
+        """
+        angle = distance / EARTH_RADIUS
+        first_delta = math.degrees(angle)
+        min_cos = math.cos(math.radians(min(abs(position[0]) + first_delta, 90)))
+        if min_cos <= 0 or math.sin(angle / 2) >= min_cos:
+            # close to a pole every value of the second coordinate may match
+            yield from self
+            return
+        second_delta = math.degrees(2 * math.asin(math.sin(angle / 2) / min_cos))
+        min_first, min_second = self.cell(
+            (position[0] - first_delta, position[1] - second_delta)
+        )
+        max_first, max_second = self.cell(
+            (position[0] + first_delta, position[1] + second_delta)
+        )
+        for first in range(min_first, max_first + 1):
+            for second in range(min_second, max_second + 1):
+                yield from self.cells.get((first, second), ())
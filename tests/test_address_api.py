@@ -1,16 +1,23 @@
+import asyncio
 from collections import namedtuple
 from unittest.mock import patch
 
 import pytest
+import pytest_asyncio
 from paperless_bt.address_api import (
+    AddressAPIClient,
     AddressAPIError,
+    AddressAPIUnavailable,
+    CircuitBreaker,
     Feature,
     FeatureCollection,
     Geometry,
     Properties,
+    RetryPolicy,
     parse_address_api_response,
     request_address_api,
 )
+from paperless_bt.address_api_stub import AddressAPIStub, Fault
 
 
 @pytest.fixture
@@ -64,3 +71,146 @@ async def test_request_address_api_not_200():
             await request_address_api(search="8+bd+du+port")
         assert "could not make http request" in str(ex.value)
         assert "400" in str(ex.value)
+
+
+@pytest_asyncio.fixture
+async def address_api_stub(address_api_json):
+    stub = AddressAPIStub(address_api_json)
+    await stub.start()
+    yield stub
+    await stub.stop()
+
+
+def make_client(stub: AddressAPIStub, **kwargs) -> AddressAPIClient:
+    kwargs.setdefault("retry_policy", RetryPolicy(attempts=3, backoff=0.001))
+    return AddressAPIClient(base_url=stub.url, **kwargs)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("status", [500, 503, 429])
+async def test_address_api_client_retries(address_api_stub, status):
+    address_api_stub.faults.extend([Fault(status=status), Fault(status=status)])
+    client = make_client(address_api_stub)
+    try:
+        response = await client.request("8+bd+du+port")
+    finally:
+        await client.close()
+    assert isinstance(parse_address_api_response(response), FeatureCollection)
+    assert address_api_stub.requests == 3
+
+
+@pytest.mark.asyncio
+async def test_address_api_client_encodes_search(address_api_stub):
+    client = make_client(address_api_stub)
+    try:
+        await client.request("rue des Arts & Métiers #2 + annexe")
+    finally:
+        await client.close()
+    assert address_api_stub.searches == ["rue des Arts & Métiers #2 + annexe"]
+
+
+@pytest.mark.asyncio
+async def test_address_api_client_does_not_retry_client_errors(address_api_stub):
+    address_api_stub.faults.append(Fault(status=404))
+    client = make_client(address_api_stub)
+    try:
+        with pytest.raises(AddressAPIError) as ex:
+            await client.request("8+bd+du+port")
+    finally:
+        await client.close()
+    assert not isinstance(ex.value, AddressAPIUnavailable)
+    assert "404" in str(ex.value)
+    assert address_api_stub.requests == 1
+
+
+@pytest.mark.asyncio
+async def test_address_api_client_read_timeout(address_api_stub):
+    address_api_stub.latency = 0.5
+    client = make_client(
+        address_api_stub,
+        read_timeout=0.05,
+        retry_policy=RetryPolicy(attempts=2, backoff=0.001),
+    )
+    try:
+        with pytest.raises(AddressAPIUnavailable):
+            await client.request("8+bd+du+port")
+    finally:
+        await client.close()
+    assert address_api_stub.requests == 2
+
+
+@pytest.mark.asyncio
+async def test_address_api_client_circuit_breaker(address_api_stub):
+    address_api_stub.error_rate = 1.0
+    client = make_client(
+        address_api_stub,
+        circuit_breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60),
+    )
+    try:
+        with pytest.raises(AddressAPIUnavailable):
+            await client.request("8+bd+du+port")
+        assert client.circuit_breaker.state == "open"
+        with pytest.raises(AddressAPIUnavailable) as ex:
+            await client.request("8+bd+du+port")
+    finally:
+        await client.close()
+    assert "circuit open" in str(ex.value)
+    # the second request failed fast without reaching the upstream
+    assert address_api_stub.requests == 2
+
+
+def test_circuit_breaker_half_open():
+    now = [0.0]
+    circuit_breaker = CircuitBreaker(
+        failure_threshold=1,
+        reset_timeout=10,
+        clock=lambda: now[0],
+    )
+    circuit_breaker.record_failure()
+    assert not circuit_breaker.allow()
+    now[0] = 10.0
+    # a single trial request is allowed once the reset timeout is elapsed
+    assert circuit_breaker.allow()
+    assert not circuit_breaker.allow()
+    circuit_breaker.record_success()
+    assert circuit_breaker.state == "closed"
+    assert circuit_breaker.allow()
+
+
+@pytest.mark.asyncio
+async def test_address_api_client_cancelled_trial(address_api_stub):
+    now = [0.0]
+    client = make_client(
+        address_api_stub,
+        retry_policy=RetryPolicy(attempts=1),
+        circuit_breaker=CircuitBreaker(
+            failure_threshold=1, reset_timeout=10, clock=lambda: now[0]
+        ),
+    )
+    address_api_stub.faults.extend([Fault(status=503), Fault(delay=1)])
+    try:
+        with pytest.raises(AddressAPIUnavailable):
+            await client.request("8+bd+du+port")
+        now[0] = 10.0
+        # the trial request is cancelled, e.g. by a client disconnecting
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(client.request("8+bd+du+port"), 0.1)
+        assert not client.circuit_breaker.trial_in_flight
+        response = await client.request("8+bd+du+port")
+    finally:
+        await client.close()
+    assert isinstance(parse_address_api_response(response), FeatureCollection)
+    assert client.circuit_breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_address_api_client_hedged_request(address_api_stub):
+    client = make_client(address_api_stub, hedge_percentile=90, hedge_min_samples=1)
+    client.latencies.record(0.01)
+    address_api_stub.faults.append(Fault(delay=1))
+    try:
+        response = await asyncio.wait_for(client.request("8+bd+du+port"), 0.5)
+    finally:
+        await client.close()
+    assert isinstance(parse_address_api_response(response), FeatureCollection)
+    assert address_api_stub.requests == 2
@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+import pytest
+from paperless_bt.admission import AdmissionController, AdmissionRejected
+
+
+def deadline(seconds: float = 1.0) -> float:
+    return time.monotonic() + seconds
+
+
+@pytest.mark.asyncio
+async def test_admission_waits_for_a_slot():
+    admission = AdmissionController("compute", concurrency=1, queue_size=1)
+    acquired_at = await admission.acquire(deadline())
+    waiting = asyncio.create_task(admission.acquire(deadline()))
+    await asyncio.sleep(0.01)
+    assert admission.metrics()["queue_depth"] == 1
+    admission.release(acquired_at)
+    admission.release(await waiting)
+    assert admission.metrics() | {"service_time_seconds": 0} == {
+        "queue_depth": 0,
+        "max_queue_depth": 1,
+        "in_flight": 0,
+        "admitted_total": 2,
+        "rejected_total": 0,
+        "service_time_seconds": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_admission_rejects_when_queue_is_full():
+    admission = AdmissionController("compute", concurrency=1, queue_size=1)
+    await admission.acquire(deadline())
+    waiting = asyncio.create_task(admission.acquire(deadline()))
+    await asyncio.sleep(0.01)
+    with pytest.raises(AdmissionRejected) as ex:
+        await admission.acquire(deadline())
+    assert ex.value.retry_after >= 1
+    assert admission.rejected == 1
+    waiting.cancel()
+
+
+@pytest.mark.asyncio
+async def test_admission_rejects_after_deadline():
+    admission = AdmissionController("compute", concurrency=1, queue_size=10)
+    await admission.acquire(deadline())
+    with pytest.raises(AdmissionRejected):
+        await admission.acquire(deadline(0.05))
+    assert admission.waiting == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_rejects_early_when_deadline_cannot_be_met():
+    admission = AdmissionController("compute", concurrency=1, queue_size=10)
+    admission.service_time = 5.0
+    await admission.acquire(deadline())
+    start = time.monotonic()
+    with pytest.raises(AdmissionRejected) as ex:
+        await admission.acquire(deadline())
+    assert time.monotonic() - start < 0.5
+    assert ex.value.retry_after == 5
+
+
+@pytest.mark.asyncio
+async def test_admission_slot():
+    admission = AdmissionController("geocode", concurrency=2, queue_size=0)
+    async with admission.slot(deadline()):
+        async with admission.slot(deadline()):
+            assert admission.in_flight == 2
+            with pytest.raises(AdmissionRejected):
+                async with admission.slot(deadline()):
+                    pass
+    assert admission.in_flight == 0
@@ -0,0 +1,377 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import aiohttp
+import pytest
+import pytest_asyncio
+import uvicorn
+from paperless_bt.address_api import (
+    Feature,
+    FeatureCollection,
+    Geometry,
+    Properties,
+)
+from paperless_bt.admission import AdmissionController
+from paperless_bt.application_router import (
+    ApplicationRouterBuilder,
+    InvalidCursor,
+    decode_cursor,
+    encode_cursor,
+    paginate_reachable_mobile_sites,
+)
+from paperless_bt.geocoder import Geocoder
+from paperless_bt.mobile_site import (
+    MobileSite,
+    MobileSiteGPS,
+    ReachableMobileSite,
+    convert_lanbert93_to_gps,
+    write_mobile_site_gps,
+)
+from paperless_bt.mobile_site_diff import MobileSiteDiff, write_mobile_site_diff
+
+
+def reachable_site(distance: float, protocol: str = "2g") -> ReachableMobileSite:
+    return ReachableMobileSite(
+        protocol=protocol,
+        distance=distance,
+        mobile_site=MobileSiteGPS(
+            provider="20801",
+            gps=(7, 10),
+            has_2g=True,
+            has_3g=True,
+            has_4g=True,
+        ),
+    )
+
+
+some_reachable_sites = [
+    reachable_site(300.0),
+    reachable_site(100.0, "4g"),
+    reachable_site(100.0),
+    reachable_site(200.0),
+]
+
+
+def test_cursor_round_trip():
+    key = (123.5, "20801", "2g", 7.0, 10.0, 0)
+    assert decode_cursor(encode_cursor(key)) == key
+
+
+# "WzEuMF0=" is a valid base64 encoding of "[1.0]", a too short key
+@pytest.mark.parametrize("cursor", ["PLOP", "WzEuMF0="])
+def test_decode_cursor_not_valid(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+
+def test_paginate_reachable_mobile_sites():
+    page, next_key = paginate_reachable_mobile_sites(some_reachable_sites, 2)
+    assert page == [reachable_site(100.0), reachable_site(100.0, "4g")]
+    assert next_key == (*reachable_site(100.0, "4g").sort_key(), 0)
+
+    page, next_key = paginate_reachable_mobile_sites(some_reachable_sites, 2, next_key)
+    assert page == [reachable_site(200.0), reachable_site(300.0)]
+    assert next_key is None
+
+
+def test_paginate_duplicated_reachable_mobile_sites():
+    reachable_sites = [reachable_site(100.0)] * 3 + [reachable_site(200.0)]
+    pages = []
+    next_key = None
+    while True:
+        page, next_key = paginate_reachable_mobile_sites(reachable_sites, 2, next_key)
+        pages.append(page)
+        if next_key is None:
+            break
+    assert pages == [
+        [reachable_site(100.0), reachable_site(100.0)],
+        [reachable_site(100.0), reachable_site(200.0)],
+    ]
+
+
+class SlowStartGeocoder(Geocoder):
+    """Geocode every search at coordinates once started is set."""
+
+    def __init__(self, coordinates: tuple[float, float] = (7, 10)):
+        self.coordinates = coordinates
+        self.started = asyncio.Event()
+        self.closed = False
+
+    async def warm_up(self) -> None:
+        await self.started.wait()
+
+    async def geocode(self, search: str) -> FeatureCollection:
+        return FeatureCollection(
+            features=[
+                Feature(
+                    geometry=Geometry(coordinates=list(self.coordinates)),
+                    properties=Properties(label=search, x=0, y=0),
+                )
+            ]
+        )
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+@pytest.fixture
+def builder(tmp_path) -> ApplicationRouterBuilder:
+    mnc_csv = tmp_path / "mnc.csv"
+    mnc_csv.write_text("MCC,MNC,Brand,Operator,State\n208,1,Orange,Orange,Ok\n")
+    mobile_sites_gps_csv = tmp_path / "mobile_sites_gps.csv"
+    mobile_sites_gps_csv.write_text(
+        "20801 7 10.03 True False True\n"
+        "20810 7 10.04 True True True\n"
+        "20801 8 10 True True True\n"
+    )
+    return ApplicationRouterBuilder(
+        str(mnc_csv),
+        str(mobile_sites_gps_csv),
+        geocoder=SlowStartGeocoder(),
+    )
+
+
+@asynccontextmanager
+async def serve(app) -> AsyncIterator[str]:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        await serving
+
+
+@pytest_asyncio.fixture
+async def server_url(builder):
+    async with serve(builder.build_app()) as url:
+        yield url
+
+
+async def get(url: str) -> tuple[int, dict]:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            return response.status, await response.json()
+
+
+@pytest.mark.asyncio
+async def test_startup_readiness(builder, server_url):
+    assert await get(f"{server_url}/healthz") == (200, {"status": "ok"})
+    assert await get(f"{server_url}/readyz") == (503, {"detail": "Starting."})
+    assert (await get(f"{server_url}/?search=plop"))[0] == 503
+
+    builder.geocoder.started.set()
+    while not builder.ready:
+        await asyncio.sleep(0.01)
+    assert await get(f"{server_url}/readyz") == (200, {"status": "ready"})
+    assert await get(f"{server_url}/?search=plop") == (
+        200,
+        {"site": {"Orange": {"2g": 1, "4g": 1}, "20810": {"2g": 1, "3g": 1, "4g": 1}}},
+    )
+    assert set(builder.startup_timings) == {
+        "read_mobile_site_gps",
+        "build_site_index",
+        "read_mnc",
+        "geocoder_warm_up",
+        "total",
+    }
+
+
+@pytest.mark.asyncio
+async def test_startup_failure(builder):
+    with open(builder.mnc_csv, "w"):
+        pass
+    builder.geocoder.started.set()
+    async with serve(builder.build_app()) as url:
+        while builder.startup_error is None:
+            await asyncio.sleep(0.01)
+        assert (await get(f"{url}/healthz"))[0] == 500
+        assert await get(f"{url}/readyz") == (503, {"detail": "Startup failed."})
+
+
+@pytest.mark.asyncio
+async def test_region(builder, server_url):
+    builder.geocoder.started.set()
+    while not builder.ready:
+        await asyncio.sleep(0.01)
+    assert await get(f"{server_url}/region?bbox=6.5,9.5,7.5,10.5&grid_size=1") == (
+        200,
+        {
+            "site": {
+                "Orange": {"2g": 1, "4g": 1},
+                "20810": {"2g": 1, "3g": 1, "4g": 1},
+            },
+            "grid_size": 1.0,
+            "density": [{"coordinates": [7.0, 10.0], "count": 2}],
+        },
+    )
+    status, polygon = await get(f"{server_url}/region?polygon=6,9,9,9,9,11,6,11")
+    assert status == 200
+    assert sum(cell["count"] for cell in polygon["density"]) == 3
+    for query in (
+        "",
+        "bbox=1,2,3",
+        "bbox=1,2,3,4&polygon=1,2,3,4,5,6",
+        "bbox=nan,0,1,1",
+        "bbox=-inf,0,1,1",
+        "polygon=0,0,1e5,0,0,1e5",
+        "bbox=6.5,9.5,7.5,10.5&grid_size=nan",
+        "bbox=6.5,9.5,7.5,10.5&grid_size=inf",
+        "bbox=6.5,9.5,7.5,10.5&grid_size=0",
+    ):
+        assert (await get(f"{server_url}/region?{query}"))[0] == 400
+
+
+class BlockingGeocoder(SlowStartGeocoder):
+    """Geocode searches once released is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.started.set()
+        self.released = asyncio.Event()
+
+    async def geocode(self, search: str) -> FeatureCollection:
+        await self.released.wait()
+        return await super().geocode(search)
+
+
+@pytest.mark.asyncio
+async def test_load_shedding(builder):
+    builder.geocoder = BlockingGeocoder()
+    builder.geocode_admission = AdmissionController("geocode", 1, queue_size=0)
+    async with serve(builder.build_app()) as url:
+        while not builder.ready:
+            await asyncio.sleep(0.01)
+        blocked = asyncio.create_task(get(f"{url}/?search=plop"))
+        while builder.geocode_admission.in_flight == 0:
+            await asyncio.sleep(0.01)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{url}/?search=plop") as response:
+                assert response.status == 503
+                assert response.headers["Retry-After"] == "1"
+            async with session.get(f"{url}/metrics") as response:
+                metrics = await response.text()
+        assert 'paperless_bt_admission_rejected_total{resource="geocode"} 1' in metrics
+        assert 'paperless_bt_admission_in_flight{resource="geocode"} 1' in metrics
+
+        builder.geocoder.released.set()
+        assert (await blocked)[0] == 200
+        assert builder.compute_admission.admitted == 1
+        assert builder.compute_admission.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_slow_geocoding_does_not_use_compute_queue_timeout(builder):
+    builder.geocoder = BlockingGeocoder()
+    builder.compute_admission = AdmissionController("compute", 1, queue_size=1)
+    builder.queue_timeout = 0.2
+    async with serve(builder.build_app()) as url:
+        while not builder.ready:
+            await asyncio.sleep(0.01)
+        search = asyncio.create_task(get(f"{url}/?search=plop"))
+        while builder.geocode_admission.in_flight == 0:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(2 * builder.queue_timeout)
+        # compute is briefly busy when the geocoding ends
+        acquired_at = await builder.compute_admission.acquire(time.monotonic())
+        builder.geocoder.released.set()
+        while builder.compute_admission.waiting == 0 and not search.done():
+            await asyncio.sleep(0.01)
+        builder.compute_admission.release(acquired_at)
+        assert (await search)[0] == 200
+        assert builder.compute_admission.rejected == 0
+
+
+@pytest.mark.asyncio
+async def test_apply_mobile_site_diff_file(builder, tmp_path):
+    amiens = MobileSite("20801", (648952, 6977867), True, False, False)
+    removed = MobileSite("20810", (649952, 6977867), True, True, False)
+    added = MobileSite("20820", (650000, 6978000), False, False, True)
+    write_mobile_site_gps(
+        builder.mobile_sites_gps_csv,
+        [convert_lanbert93_to_gps(amiens), convert_lanbert93_to_gps(removed)],
+    )
+    diff = str(tmp_path / "sites.diff")
+    write_mobile_site_diff(diff, MobileSiteDiff(removed=[removed], added=[added]))
+    builder.geocoder = SlowStartGeocoder(convert_lanbert93_to_gps(amiens).gps)
+    assert not builder.apply_mobile_site_diff_file(diff)
+
+    builder.geocoder.started.set()
+    async with serve(builder.build_app()) as url:
+        while not builder.ready:
+            await asyncio.sleep(0.01)
+        assert await get(f"{url}/?search=plop") == (
+            200,
+            {"site": {"Orange": {"2g": 1}, "20810": {"2g": 1, "3g": 1}}},
+        )
+        served_index = builder.site_index
+        assert builder.apply_mobile_site_diff_file(diff)
+        assert await get(f"{url}/?search=plop") == (
+            200,
+            {"site": {"Orange": {"2g": 1}, "20820": {"4g": 1}}},
+        )
+        # searches running on the previous index are not disturbed
+        assert len(served_index) == 2
+        # the diff is applied once
+        assert not builder.apply_mobile_site_diff_file(diff)
+        assert not builder.apply_mobile_site_diff_file(str(tmp_path / "missing"))
+
+
+@pytest.mark.asyncio
+async def test_apply_additions_only_mobile_site_diff_file_once(builder, tmp_path):
+    added = MobileSite("20820", (650000, 6978000), False, False, True)
+    diff = str(tmp_path / "sites.diff")
+    write_mobile_site_diff(diff, MobileSiteDiff(added=[added]))
+    await builder.load_dataset()
+    size = len(builder.site_index)
+    assert builder.apply_mobile_site_diff_file(diff)
+    assert not builder.apply_mobile_site_diff_file(diff)
+    assert len(builder.site_index) == size + 1
+    # another diff adding the same site is applied
+    write_mobile_site_diff(diff, MobileSiteDiff(added=[added, added]))
+    assert builder.apply_mobile_site_diff_file(diff)
+    assert len(builder.site_index) == size + 3
+
+
+@pytest.mark.asyncio
+async def test_stream_options(builder, server_url):
+    builder.geocoder.started.set()
+    while not builder.ready:
+        await asyncio.sleep(0.01)
+    for query in ("limit=1", "page_size=1", "cursor=plop"):
+        status, _ = await get(f"{server_url}/?search=plop&stream=true&{query}")
+        assert status == 400
+
+
+@pytest.mark.asyncio
+async def test_stream(builder, server_url):
+    builder.geocoder.started.set()
+    while not builder.ready:
+        await asyncio.sleep(0.01)
+    threads = set()
+    resolve_provider = builder.resolve_provider
+
+    def record_thread(provider: str) -> str:
+        threads.add(threading.get_ident())
+        return resolve_provider(provider)
+
+    builder.resolve_provider = record_thread
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{server_url}/?search=plop&stream=true") as response:
+            assert response.status == 200
+            lines = (await response.text()).splitlines()
+    assert len(lines) == 5
+    assert {json.loads(line)["provider"] for line in lines} == {"Orange", "20810"}
+    # the lines are produced out of the event loop thread
+    assert threading.get_ident() not in threads
+    assert builder.compute_admission.in_flight == 0
@@ -0,0 +1,113 @@
+import multiprocessing
+
+import pytest
+from paperless_bt.address_api import (
+    Feature,
+    FeatureCollection,
+    Geometry,
+    Properties,
+)
+from paperless_bt.geocode_cache import (
+    CachingGeocoder,
+    GeocodeCache,
+    normalize_search,
+)
+from paperless_bt.geocoder import Geocoder
+
+some_collection = FeatureCollection(
+    features=[
+        Feature(
+            geometry=Geometry(coordinates=[2.290084, 49.897442]),
+            properties=Properties(
+                label="8 Boulevard du Port 80000 Amiens",
+                x=648952.58,
+                y=6977867.14,
+            ),
+        )
+    ]
+)
+
+
+class CountingGeocoder(Geocoder):
+    def __init__(self, collection: FeatureCollection):
+        self.collection = collection
+        self.calls = 0
+
+    async def geocode(self, search: str) -> FeatureCollection:
+        self.calls += 1
+        return self.collection
+
+
+def test_normalize_search():
+    assert normalize_search(" 8+Bd+du  port ") == "8 bd du port"
+
+
+def test_geocode_cache_ttl(tmp_path):
+    now = [0.0]
+    cache = GeocodeCache(str(tmp_path / "cache.sqlite"), ttl=10, clock=lambda: now[0])
+    assert cache.get("8+bd+du+port") is None
+    cache.put("8+bd+du+port", some_collection)
+    assert cache.get("8 bd du port") == some_collection
+    now[0] = 11.0
+    assert cache.get("8 bd du port") is None
+    assert cache.compact() == 1
+    assert len(cache) == 0
+
+
+def test_geocode_cache_compact_keeps_most_recently_used(tmp_path):
+    now = [0.0]
+    cache = GeocodeCache(
+        str(tmp_path / "cache.sqlite"),
+        max_entries=2,
+        compact_every=3,
+        clock=lambda: now[0],
+    )
+    for search in ("a", "b"):
+        cache.put(search, some_collection)
+        now[0] += 100
+    # "a" is now more recent than "b"
+    assert "a" in cache
+    cache.put("c", some_collection)
+    assert len(cache) == 2
+    assert "a" in cache
+    assert "b" not in cache
+
+
+def put_from_other_process(path: str) -> None:
+    GeocodeCache(path).put("8 bd du port", some_collection)
+
+
+def test_geocode_cache_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = GeocodeCache(path)
+    assert cache.get("8 bd du port") is None
+    process = multiprocessing.get_context("spawn").Process(
+        target=put_from_other_process, args=(path,)
+    )
+    process.start()
+    process.join()
+    assert cache.get("8 bd du port") == some_collection
+
+
+@pytest.mark.asyncio
+async def test_caching_geocoder(tmp_path):
+    geocoder = CountingGeocoder(some_collection)
+    caching_geocoder = CachingGeocoder(
+        geocoder, GeocodeCache(str(tmp_path / "cache.sqlite"))
+    )
+    assert await caching_geocoder.geocode("8+bd+du+port") == some_collection
+    assert await caching_geocoder.geocode("8 bd du port") == some_collection
+    await caching_geocoder.close()
+    assert geocoder.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_caching_geocoder_does_not_cache_empty_results(tmp_path):
+    geocoder = CountingGeocoder(FeatureCollection(features=[]))
+    caching_geocoder = CachingGeocoder(
+        geocoder, GeocodeCache(str(tmp_path / "cache.sqlite"))
+    )
+    await caching_geocoder.geocode("nowhere")
+    await caching_geocoder.geocode("nowhere")
+    await caching_geocoder.close()
+    assert geocoder.calls == 2
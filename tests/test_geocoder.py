@@ -0,0 +1,118 @@
+import pytest
+import pytest_asyncio
+from paperless_bt.address_api import AddressAPIClient, FeatureCollection
+from paperless_bt.address_api_stub import AddressAPIStub
+from paperless_bt.geocoder import (
+    AddressAPIGeocoder,
+    BANFormatError,
+    GeocoderError,
+    LocalGeocoder,
+    build_local_geocoder_index,
+    search_to_fts_query,
+)
+
+BAN_CSV = """id;id_fantoir;numero;rep;nom_voie;code_postal;code_insee;nom_commune;code_insee_ancienne_commune;nom_ancienne_commune;x;y;lon;lat
+80021_6590_00008;80021_6590;8;;Boulevard du Port;80000;80021;Amiens;;;648952.58;6977867.14;2.290084;49.897442
+95127_1448_00008;95127_1448;8;bis;Boulevard du Port;95000;95127;Cergy;;;631466.41;6881718.82;2.062794;49.0317
+75109_5507_00008;75109_5507;8;;Rue La Fayette;75009;75109;Paris;;;651767.36;6863588.57;2.334332;48.873258
+"""  # noqa: E501
+
+
+@pytest.fixture
+def geocoder_index(tmp_path) -> str:
+    ban_csv = tmp_path / "ban.csv"
+    ban_csv.write_text(BAN_CSV)
+    index = str(tmp_path / "geocoder.sqlite")
+    assert build_local_geocoder_index(str(ban_csv), index) == 3
+    return index
+
+
+@pytest.mark.parametrize(
+    "search,expected",
+    [
+        ("8+bd+du+port", '"8" "boulevard" "du" "port"*'),
+        ("Rue La Fay", '"rue" "la" "fay"*'),
+    ],
+)
+def test_search_to_fts_query(search, expected):
+    assert search_to_fts_query(search) == expected
+
+
+def test_search_to_fts_query_empty():
+    with pytest.raises(GeocoderError):
+        search_to_fts_query("+ ,")
+
+
+@pytest.mark.asyncio
+async def test_local_geocoder(geocoder_index):
+    geocoder = LocalGeocoder(geocoder_index)
+    features = (await geocoder.geocode("8+bd+du+port+amiens")).features
+    await geocoder.close()
+    assert len(features) == 1
+    assert features[0].properties.label == "8 Boulevard du Port 80000 Amiens"
+    assert features[0].geometry.coordinates == [2.290084, 49.897442]
+    assert features[0].properties.x == 648952.58
+
+
+@pytest.mark.asyncio
+async def test_local_geocoder_prefix_and_no_match(geocoder_index):
+    geocoder = LocalGeocoder(geocoder_index)
+    labels = [
+        feature.properties.label
+        for feature in (await geocoder.geocode("8 boulevard du po")).features
+    ]
+    assert sorted(labels) == [
+        "8 Boulevard du Port 80000 Amiens",
+        "8 bis Boulevard du Port 95000 Cergy",
+    ]
+    assert (await geocoder.geocode("avenue foch")).features == []
+    await geocoder.close()
+
+
+def test_local_geocoder_missing_index(tmp_path):
+    with pytest.raises(GeocoderError):
+        LocalGeocoder(str(tmp_path / "missing.sqlite"))
+
+
+@pytest.mark.parametrize("content", ["", "numero;nom_voie\n8;Rue\n"])
+def test_build_local_geocoder_index_format_error(tmp_path, content):
+    ban_csv = tmp_path / "ban.csv"
+    ban_csv.write_text(content)
+    with pytest.raises(BANFormatError):
+        build_local_geocoder_index(str(ban_csv), str(tmp_path / "geocoder.sqlite"))
+
+
+@pytest.mark.asyncio
+async def test_build_local_geocoder_index_keeps_index_on_error(
+    tmp_path, geocoder_index
+):
+    ban_csv = tmp_path / "ban.csv"
+    ban_csv.write_text(BAN_CSV + "80021_6590_00009;80021_6590;plop\n")
+    with pytest.raises(BANFormatError):
+        build_local_geocoder_index(str(ban_csv), geocoder_index)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "ban.csv",
+        "geocoder.sqlite",
+    ]
+    geocoder = LocalGeocoder(geocoder_index)
+    features = (await geocoder.geocode("8+bd+du+port+amiens")).features
+    await geocoder.close()
+    assert len(features) == 1
+
+
+@pytest_asyncio.fixture
+async def address_api_stub():
+    with open("address_api.json") as f:
+        stub = AddressAPIStub(f.read())
+    await stub.start()
+    yield stub
+    await stub.stop()
+
+
+@pytest.mark.asyncio
+async def test_address_api_geocoder(address_api_stub):
+    geocoder = AddressAPIGeocoder(AddressAPIClient(base_url=address_api_stub.url))
+    collection = await geocoder.geocode("8+bd+du+port")
+    await geocoder.close()
+    assert isinstance(collection, FeatureCollection)
+    assert collection.features[0].geometry.coordinates == [2.290084, 49.897442]
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from paperless_bt.loadtest import LoadTest, LoadTestResult
+from paperless_bt.request_log import LoggedRequest
+
+
+def test_load_test_result():
+    result = LoadTestResult(
+        duration=2.0,
+        latencies=[0.01 * i for i in range(1, 101)],
+    )
+    result.statuses.update({200: 97, 503: 2})
+    result.failures["ServerDisconnectedError"] += 1
+    assert result.throughput() == 50.0
+    assert result.percentile(50) == pytest.approx(0.51)
+    assert result.percentile(99) == pytest.approx(1.0)
+    assert result.error_rate() == pytest.approx(0.03)
+    assert "p99=1000.0ms" in result.report()
+    assert result.summary()["statuses"] == {"200": 97, "503": 2}
+
+
+@pytest_asyncio.fixture
+async def server_url():
+    async def search(request: web.Request) -> web.Response:
+        if request.query["search"] == "fail":
+            return web.Response(status=500)
+        return web.json_response({"site": {}})
+
+    app = web.Application()
+    app.router.add_get("/", search)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    yield f"http://{host}:{port}"
+    await runner.cleanup()
+
+
+requests = [LoggedRequest(search="plop"), LoggedRequest(search="fail", full=True)]
+
+
+@pytest.mark.asyncio
+async def test_load_test_closed_loop(server_url):
+    result = await LoadTest(server_url, requests, concurrency=2).run()
+    assert result.statuses == {200: 1, 500: 1}
+    assert result.error_rate() == 0.5
+
+
+@pytest.mark.asyncio
+async def test_load_test_open_loop(server_url):
+    start = time.monotonic()
+    result = await LoadTest(server_url, requests, rps=50, duration=0.2).run()
+    assert time.monotonic() - start >= 0.18
+    assert result.requests == 10
+    assert result.statuses == {200: 5, 500: 5}
@@ -0,0 +1,48 @@
+import subprocess
+import sys
+
+import pytest
+from click.testing import CliRunner
+from paperless_bt.main import cli
+
+HEAVY_DEPENDENCIES = {"fastapi", "uvicorn", "aiohttp", "pyproj"}
+
+# microseconds, several times what it takes today to leave room for slow CI
+IMPORT_TIME_BUDGET = {
+    "paperless_bt.main": 150_000,
+    "paperless_bt.mobile_site": 150_000,
+}
+
+
+def cumulative_import_times(module: str) -> dict[str, int]:
+    """Cumulative import time of every module imported by module, in us."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    res = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        res[name.strip()] = int(cumulative)
+    return res
+
+
+@pytest.mark.parametrize("module", IMPORT_TIME_BUDGET)
+def test_import_does_not_load_heavy_dependencies(module):
+    assert HEAVY_DEPENDENCIES & cumulative_import_times(module).keys() == set()
+
+
+@pytest.mark.parametrize("module,budget", IMPORT_TIME_BUDGET.items())
+def test_import_time_budget(module, budget):
+    # the best of a few runs, to not fail because of a busy machine
+    assert min(cumulative_import_times(module)[module] for _ in range(3)) < budget
+
+
+def test_help():
+    result = CliRunner().invoke(cli, ["--help"])
+    assert result.exit_code == 0
+    assert "generate" in result.output
@@ -12,6 +12,8 @@ from paperless_bt.mobile_site import (
     UnknownProvider,
     convert_lanbert93_to_gps,
     filter_reachable_mobile_sites,
+    iter_reachable_mobile_sites,
+    limit_reachable_mobile_sites,
     mobile_site_gps_row_to_mobilesite,
     mobile_site_row_to_mobilesite,
     read_mnc,
@@ -299,3 +301,37 @@ def test_filter_reachable_mobile_sites():
             ],
         }
     }
+
+
+def test_iter_reachable_mobile_sites():
+    reachable_sites = list(iter_reachable_mobile_sites((7, 10), some_mobile_sites))
+    assert [
+        (reachable_site.protocol, reachable_site.mobile_site.gps)
+        for reachable_site in reachable_sites
+    ] == [
+        ("2g", (7, 10.03)),
+        ("4g", (7, 10.03)),
+        ("2g", (7, 10.04)),
+        ("3g", (7, 10.04)),
+        ("4g", (7, 10.04)),
+        ("2g", (7, 10.08)),
+        ("2g", (7, 10.09)),
+        ("4g", (7, 10.09)),
+        ("2g", (7, 10.27)),
+    ]
+    assert all(reachable_site.distance < 30e3 for reachable_site in reachable_sites)
+
+
+def test_limit_reachable_mobile_sites():
+    reachable_sites = limit_reachable_mobile_sites(
+        iter_reachable_mobile_sites((7, 10), some_mobile_sites),
+        limit=1,
+    )
+    assert [
+        (reachable_site.protocol, reachable_site.mobile_site.gps)
+        for reachable_site in reachable_sites
+    ] == [
+        ("2g", (7, 10.03)),
+        ("4g", (7, 10.03)),
+        ("3g", (7, 10.04)),
+    ]
@@ -0,0 +1,142 @@
+import pytest
+from paperless_bt.mobile_site import (
+    MobileSite,
+    convert_lanbert93_to_gps,
+    read_mobile_site,
+    read_mobile_site_gps,
+    write_mobile_site_gps,
+)
+from paperless_bt.mobile_site_diff import (
+    MobileSiteDiff,
+    MobileSiteDiffError,
+    MobileSiteDiffFormatError,
+    MobileSiteGPSDiff,
+    apply_mobile_site_diff_to_gps_csv,
+    convert_mobile_site_diff,
+    diff_mobile_sites,
+    patch_mobile_sites_gps,
+    read_mobile_site_diff,
+    write_mobile_site_diff,
+)
+
+OLD_EXPORT = """Operateur;x;y;2G;3G;4G
+20801;102980;6847973;1;1;0
+20801;102980;6847973;1;1;0
+20810;103113;6848661;1;1;0
+20820;103114;6848664;1;1;1
+"""
+
+NEW_EXPORT = """Operateur;x;y;2G;3G;4G
+20801;102980;6847973;1;1;0
+20810;103113;6848661;1;1;1
+20820;103114;6848664;1;1;1
+20815;1240585;6154019;0;0;1
+"""
+
+
+def mobile_site(
+    provider: str,
+    lambert93: tuple[int, int],
+    has_2g: bool,
+    has_3g: bool,
+    has_4g: bool,
+) -> MobileSite:
+    return MobileSite(
+        provider=provider,
+        lambert93=lambert93,
+        has_2g=has_2g,
+        has_3g=has_3g,
+        has_4g=has_4g,
+    )
+
+
+@pytest.fixture
+def exports(tmp_path) -> tuple[str, str]:
+    old = tmp_path / "old.csv"
+    old.write_text(OLD_EXPORT)
+    new = tmp_path / "new.csv"
+    new.write_text(NEW_EXPORT)
+    return str(old), str(new)
+
+
+def test_diff_mobile_sites(exports):
+    diff = diff_mobile_sites(
+        read_mobile_site(exports[0]),
+        read_mobile_site(exports[1]),
+    )
+    assert diff == MobileSiteDiff(
+        removed=[
+            mobile_site("20801", (102980, 6847973), True, True, False),
+            mobile_site("20810", (103113, 6848661), True, True, False),
+        ],
+        added=[
+            mobile_site("20810", (103113, 6848661), True, True, True),
+            mobile_site("20815", (1240585, 6154019), False, False, True),
+        ],
+    )
+    assert diff.changed_keys() == {("20810", (103113, 6848661))}
+    assert diff.changed_count() == 1
+
+
+def test_mobile_site_diff_changed_count_with_duplicated_keys():
+    diff = MobileSiteDiff(
+        removed=[
+            mobile_site("20801", (102980, 6847973), True, True, False),
+            mobile_site("20801", (102980, 6847973), True, True, False),
+            mobile_site("20810", (103113, 6848661), True, True, False),
+        ],
+        added=[
+            mobile_site("20801", (102980, 6847973), True, True, True),
+            mobile_site("20801", (102980, 6847973), True, True, True),
+            mobile_site("20815", (1240585, 6154019), False, False, True),
+        ],
+    )
+    assert diff.changed_count() == 2
+
+
+def test_mobile_site_diff_round_trip(exports, tmp_path):
+    diff = diff_mobile_sites(
+        read_mobile_site(exports[0]),
+        read_mobile_site(exports[1]),
+    )
+    filename = str(tmp_path / "diff.csv")
+    write_mobile_site_diff(filename, diff)
+    assert read_mobile_site_diff(filename) == diff
+
+
+@pytest.mark.parametrize("content", ["", "Op;Operateur\n*;20801;1;2;1;1;1\n"])
+def test_read_mobile_site_diff_format_error(tmp_path, content):
+    filename = tmp_path / "diff.csv"
+    filename.write_text(content)
+    with pytest.raises(MobileSiteDiffFormatError):
+        read_mobile_site_diff(str(filename))
+
+
+def test_apply_mobile_site_diff_matches_full_generation(exports, tmp_path):
+    old, new = exports
+    gps_csv = str(tmp_path / "gps.csv")
+    write_mobile_site_gps(
+        gps_csv, (convert_lanbert93_to_gps(site) for site in read_mobile_site(old))
+    )
+    apply_mobile_site_diff_to_gps_csv(
+        gps_csv,
+        convert_mobile_site_diff(
+            diff_mobile_sites(read_mobile_site(old), read_mobile_site(new))
+        ),
+    )
+
+    def sort_key(site):
+        return (site.provider, site.gps, site.has_2g, site.has_3g, site.has_4g)
+
+    assert sorted(read_mobile_site_gps(gps_csv), key=sort_key) == sorted(
+        (convert_lanbert93_to_gps(site) for site in read_mobile_site(new)),
+        key=sort_key,
+    )
+
+
+def test_patch_mobile_sites_gps_missing_site():
+    site = convert_lanbert93_to_gps(
+        mobile_site("20801", (102980, 6847973), True, True, False)
+    )
+    with pytest.raises(MobileSiteDiffError):
+        patch_mobile_sites_gps([], MobileSiteGPSDiff(removed=[site]))
@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+from fastapi import FastAPI
+from paperless_bt.profiling import (
+    StackSampler,
+    add_profiling,
+    asgi_get,
+    profile_requests,
+    run_in_thread,
+)
+from paperless_bt.request_log import LoggedRequest
+
+
+def busy_loop(seconds: float) -> str:
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+    return threading.current_thread().name
+
+
+def test_stack_sampler():
+    with StackSampler(interval=0.001) as sampler:
+        busy_loop(0.1)
+    folded = sampler.folded()
+    assert "test_profiling.py:test_stack_sampler;test_profiling.py:busy_loop" in folded
+    for line in folded.splitlines():
+        assert int(line.rsplit(" ", 1)[1]) > 0
+
+
+@pytest.fixture
+def app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/")
+    async def root(search: str) -> dict[str, str]:
+        return {"thread": await run_in_thread(busy_loop, 0.05), "search": search}
+
+    add_profiling(app, admin_token="secret")
+    return app
+
+
+@pytest.mark.asyncio
+async def test_profiling_forbidden(app):
+    assert (await asgi_get(app, "/", "search=plop"))[0] == 200
+    for headers in (
+        {"X-Profile": "cprofile"},
+        {"X-Profile": "cprofile", "X-Admin-Token": "plop"},
+    ):
+        assert (await asgi_get(app, "/", "search=plop", headers))[0] == 403
+    headers = {"X-Profile": "plop", "X-Admin-Token": "secret"}
+    assert (await asgi_get(app, "/", "search=plop", headers))[0] == 400
+
+
+@pytest.mark.asyncio
+async def test_profiling_disabled_without_admin_token():
+    app = FastAPI()
+
+    @app.get("/")
+    async def root() -> str:
+        return "plop"
+
+    add_profiling(app, admin_token=None)
+    assert app.user_middleware == []
+    headers = {"X-Profile": "cprofile", "X-Admin-Token": ""}
+    assert await asgi_get(app, "/", "", headers) == (200, b'"plop"')
+
+
+@pytest.mark.asyncio
+async def test_profiling_cprofile(app):
+    status, body = await asgi_get(
+        app, "/", "search=plop", {"X-Profile": "cprofile", "X-Admin-Token": "secret"}
+    )
+    assert status == 200
+    assert "busy_loop" in body.decode()
+    assert "cumulative" in body.decode()
+
+
+@pytest.mark.asyncio
+async def test_profiling_sample(app):
+    status, body = await asgi_get(
+        app, "/", "search=plop", {"X-Profile": "sample", "X-Admin-Token": "secret"}
+    )
+    assert status == 200
+    assert "test_profiling.py:busy_loop" in body.decode()
+
+
+@pytest.mark.asyncio
+async def test_profile_requests(app):
+    sampler, statuses = await profile_requests(
+        app, [LoggedRequest(search="plop"), LoggedRequest(search="plip", full=True)]
+    )
+    assert statuses == {200: 2}
+    assert "test_profiling.py:busy_loop" in sampler.folded()
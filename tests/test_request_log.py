@@ -0,0 +1,33 @@
+import pytest
+from paperless_bt.request_log import (
+    LoggedRequest,
+    RequestLogFormatError,
+    read_request_log,
+    request_query_string,
+)
+
+
+def test_read_request_log(tmp_path):
+    request_log = tmp_path / "requests.jsonl"
+    request_log.write_text(
+        '{"search": "8 bd du port", "full": true}\n\n{"q": "8+rue+la+fayette"}\n'
+    )
+    assert read_request_log(str(request_log)) == [
+        LoggedRequest(search="8 bd du port", full=True),
+        LoggedRequest(search="8+rue+la+fayette", full=False),
+    ]
+
+
+@pytest.mark.parametrize("content", ["", "PLOP\n", '{"full": true}\n', "[1]\n"])
+def test_read_request_log_format_error(tmp_path, content):
+    request_log = tmp_path / "requests.jsonl"
+    request_log.write_text(content)
+    with pytest.raises(RequestLogFormatError):
+        read_request_log(str(request_log))
+
+
+def test_request_query_string():
+    assert (
+        request_query_string(LoggedRequest(search="8 bd du port", full=True))
+        == "search=8+bd+du+port&full=true"
+    )
@@ -0,0 +1,144 @@
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import urllib.request
+from contextlib import asynccontextmanager
+
+import pytest
+from fastapi import FastAPI
+from paperless_bt.serving import PreforkServer, read_worker_memory
+
+app = FastAPI()
+
+
+reloads = 0
+
+
+@app.get("/")
+async def root() -> int:
+    return os.getpid()
+
+
+@app.get("/reloads")
+async def get_reloads() -> int:
+    return reloads
+
+
+def reload() -> None:
+    global reloads
+    reloads += 1
+
+
+@asynccontextmanager
+async def slow_start(app):
+    time.sleep(1)
+    yield
+
+
+slow_start_app = FastAPI(lifespan=slow_start)
+slow_start_app.get("/")(root)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(
+    port: int,
+    workers: int,
+    max_requests: int | None,
+    slow: bool = False,
+) -> None:
+    PreforkServer(
+        slow_start_app if slow else app,
+        port=port,
+        workers=workers,
+        max_requests=max_requests,
+        memory_report_interval=None,
+        log_level="warning",
+        on_reload=reload,
+    ).run()
+
+
+def get(port: int, path: str = "/", timeout: float = 10) -> int:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}") as response:
+                return json.loads(response.read())
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+@pytest.fixture
+def prefork_server(request):
+    port = free_port()
+    process = multiprocessing.get_context("spawn").Process(
+        target=serve, args=(port, *request.param)
+    )
+    process.start()
+    yield port, process.pid
+    os.kill(process.pid, signal.SIGTERM)
+    process.join(10)
+    assert process.exitcode == 0
+
+
+def test_read_worker_memory():
+    memory = read_worker_memory(os.getpid())
+    assert memory.rss > 0
+    assert memory.pss > 0
+    assert memory.shared + memory.private == pytest.approx(memory.rss, rel=0.05)
+
+
+@pytest.mark.parametrize("prefork_server", [(2, None)], indirect=True)
+def test_prefork_server_workers(prefork_server):
+    port, _ = prefork_server
+    pids = {get(port) for _ in range(20)}
+    assert 1 <= len(pids) <= 2
+    assert os.getpid() not in pids
+
+
+@pytest.mark.parametrize("prefork_server", [(1, 2)], indirect=True)
+def test_prefork_server_recycles_workers(prefork_server):
+    port, _ = prefork_server
+    pids = []
+    for _ in range(10):
+        pids.append(get(port))
+        # let the worker notice it reached its limit
+        time.sleep(0.15)
+    assert len(set(pids)) >= 3
+
+
+@pytest.mark.parametrize("prefork_server", [(2, None)], indirect=True)
+def test_prefork_server_reload(prefork_server):
+    port, pid = prefork_server
+    assert get(port, "/reloads") == 0
+    os.kill(pid, signal.SIGHUP)
+    deadline = time.monotonic() + 10
+    # workers are forked again from the reloaded main process
+    while get(port, "/reloads") != 1:
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+
+@pytest.mark.parametrize("prefork_server", [(1, None, True)], indirect=True)
+def test_prefork_server_recycles_workers_one_by_one(prefork_server):
+    port, pid = prefork_server
+    first_pid = get(port)
+    os.kill(pid, signal.SIGHUP)
+    # the old worker keeps serving while its replacement starts
+    pids = []
+    while len(pids) < 30 and (not pids or pids[-1] == first_pid):
+        start = time.monotonic()
+        pids.append(get(port))
+        assert time.monotonic() - start < 0.5
+        time.sleep(0.1)
+    assert pids[0] == first_pid
+    assert pids[-1] != first_pid
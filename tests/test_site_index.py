@@ -0,0 +1,193 @@
+import random
+
+import pytest
+from paperless_bt.coordinates import compute_haversine
+from paperless_bt.mobile_site import MobileSiteGPS
+from paperless_bt.mobile_site_diff import MobileSiteGPSDiff
+from paperless_bt.site_index import (
+    InvalidRegion,
+    MobileSiteIndex,
+    MobileSiteNotIndexed,
+    parse_bbox,
+    parse_polygon,
+    point_in_polygon,
+)
+
+
+def mobile_site(gps: tuple[float, float], provider: str = "20801") -> MobileSiteGPS:
+    return MobileSiteGPS(
+        provider=provider,
+        gps=gps,
+        has_2g=True,
+        has_3g=True,
+        has_4g=True,
+    )
+
+
+@pytest.fixture
+def random_mobile_sites() -> list[MobileSiteGPS]:
+    generator = random.Random(42)
+    return [
+        mobile_site((generator.uniform(-5, 10), generator.uniform(41, 51)))
+        for _ in range(5000)
+    ]
+
+
+@pytest.mark.parametrize("distance", [5e3, 30e3, 200e3])
+def test_near_is_a_superset_of_sites_within_distance(random_mobile_sites, distance):
+    index = MobileSiteIndex(random_mobile_sites)
+    for position in ((2.29, 49.89), (-4.9, 41.1), (9.9, 50.9)):
+        near = list(index.near(position, distance))
+        within = [
+            site
+            for site in random_mobile_sites
+            if compute_haversine(position[0], site.gps[0], position[1], site.gps[1])
+            < distance
+        ]
+        assert all(site in near for site in within)
+        assert len(near) < len(random_mobile_sites)
+
+
+def test_insert_and_remove():
+    index = MobileSiteIndex([mobile_site((7, 10)), mobile_site((7, 10))])
+    index.insert(mobile_site((7.5, 10)))
+    assert len(index) == 3
+    index.remove(mobile_site((7, 10)))
+    assert sorted(site.gps for site in index) == [(7, 10), (7.5, 10)]
+    with pytest.raises(MobileSiteNotIndexed):
+        index.remove(mobile_site((7.5, 10), provider="20810"))
+
+
+def test_apply_diff():
+    index = MobileSiteIndex([mobile_site((7, 10))])
+    index.apply_diff(
+        MobileSiteGPSDiff(
+            removed=[mobile_site((7, 10))],
+            added=[mobile_site((7, 10.01), provider="20810")],
+        )
+    )
+    assert list(index) == [mobile_site((7, 10.01), provider="20810")]
+
+
+def test_apply_diff_is_atomic():
+    index = MobileSiteIndex([mobile_site((7, 10)), mobile_site((8, 10))])
+    with pytest.raises(MobileSiteNotIndexed):
+        index.apply_diff(
+            MobileSiteGPSDiff(
+                removed=[mobile_site((7, 10)), mobile_site((9, 10))],
+                added=[mobile_site((7, 10.01))],
+            )
+        )
+    assert sorted(site.gps for site in index) == [(7, 10), (8, 10)]
+
+
+def test_patched():
+    index = MobileSiteIndex([mobile_site((7, 10)), mobile_site((8, 10))])
+    patched = index.patched(
+        MobileSiteGPSDiff(
+            removed=[mobile_site((7, 10))],
+            added=[mobile_site((7, 10.01), provider="20810")],
+        )
+    )
+    assert sorted(site.gps for site in patched) == [(7, 10.01), (8, 10)]
+    assert sorted(site.gps for site in index) == [(7, 10), (8, 10)]
+    # untouched cells are shared
+    assert patched.cells[index.cell((8, 10))] is index.cells[index.cell((8, 10))]
+
+
+def test_parse_bbox():
+    assert parse_bbox("1,2,3,4") == [(1, 2), (3, 2), (3, 4), (1, 4)]
+
+
+def test_parse_polygon():
+    assert parse_polygon("1,2,3,4,5,6") == [(1, 2), (3, 4), (5, 6)]
+
+
+@pytest.mark.parametrize(
+    "parse,value",
+    [
+        (parse_bbox, "1,2,3"),
+        (parse_bbox, "3,2,1,4"),
+        (parse_bbox, "a,2,3,4"),
+        (parse_bbox, "nan,0,1,1"),
+        (parse_bbox, "-inf,0,1,1"),
+        (parse_bbox, "-181,0,1,1"),
+        (parse_bbox, "0,0,1,91"),
+        (parse_polygon, "1,2,3,4"),
+        (parse_polygon, "1,2,3,4,5"),
+        (parse_polygon, "0,0,1e5,0,0,1e5"),
+        (parse_polygon, "0,0,1,0,0,nan"),
+    ],
+)
+def test_parse_region_not_valid(parse, value):
+    with pytest.raises(InvalidRegion):
+        parse(value)
+
+
+@pytest.mark.parametrize(
+    "point,inside",
+    [
+        ((0.5, 0.5), True),
+        ((1.5, 0.5), True),
+        ((0.5, 1.5), True),
+        ((1.5, 1.5), False),
+        ((3, 0.5), False),
+    ],
+)
+def test_point_in_polygon(point, inside):
+    # a square of side 2 with its upper right quarter cut out
+    polygon = [(0, 0), (2, 0), (2, 1), (1, 1), (1, 2), (0, 2)]
+    assert point_in_polygon(point, polygon) == inside
+
+
+@pytest.mark.parametrize(
+    "polygon",
+    [
+        parse_bbox("-1,43,3,50"),
+        parse_polygon("-1,43,3,50,7,44,3,46.5"),
+        parse_polygon("2.05,48.3,2.07,48.31,2.06,48.35"),
+        parse_bbox("-20,30,30,60"),
+    ],
+)
+def test_within(random_mobile_sites, polygon):
+    index = MobileSiteIndex(random_mobile_sites)
+    assert sorted(id(site) for site in index.within(polygon)) == sorted(
+        id(site) for site in random_mobile_sites if point_in_polygon(site.gps, polygon)
+    )
+
+
+def test_within_walks_index_bounds_only(random_mobile_sites):
+    index = MobileSiteIndex(random_mobile_sites)
+    polygon = parse_polygon("-180,-90,180,-90,180,90")
+    (min_first, min_second), (max_first, max_second) = index.bounds()
+    assert all(
+        min_first <= first <= max_first and min_second <= second <= max_second
+        for first, second in index.boundary_cells(polygon)
+    )
+    assert sorted(id(site) for site in index.within(polygon)) == sorted(
+        id(site) for site in random_mobile_sites if point_in_polygon(site.gps, polygon)
+    )
+    assert list(MobileSiteIndex().within(polygon)) == []
+
+
+def test_coverage():
+    index = MobileSiteIndex(
+        [
+            mobile_site((7.01, 10.01)),
+            mobile_site((7.02, 10.01), provider="20810"),
+            MobileSiteGPS(
+                provider="20801",
+                gps=(7.51, 10.01),
+                has_2g=False,
+                has_3g=False,
+                has_4g=True,
+            ),
+            mobile_site((9, 10)),
+        ]
+    )
+    coverage = index.coverage(parse_bbox("7,10,8,11"), grid_size=0.5)
+    assert coverage.site == {
+        "20801": {"2g": 1, "3g": 1, "4g": 2},
+        "20810": {"2g": 1, "3g": 1, "4g": 1},
+    }
+    assert coverage.density == {(7.0, 10.0): 2, (7.5, 10.0): 1}